@@ -0,0 +1,761 @@
+# Замеры производительности telfbook.CardList
+# Запуск: python bench_telfbook.py [имя_замера ...]
+import os
+import sys
+import time
+import random
+import tempfile
+import tracemalloc
+import asyncio
+import json
+import platform
+import subprocess
+import threading
+import heapq
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import resource
+except ImportError:
+    # Windows: пиковый RSS не измеряется
+    resource = None
+
+import telfbook as tb
+
+
+def fill_cards(db: tb.CardList, n: int):
+    '''
+    Быстро наполняет БД n одинаковыми по структуре карточками (напрямую через executemany)
+    '''
+    stamp = tb.timestamp()
+    conn = db._connect()
+    conn.executemany(
+        "INSERT INTO cards (name, tlf1, comment, cr_dt, upd_dt) VALUES (?, ?, ?, ?, ?);",
+        (('Name {0}'.format(i), '8912{0:0>7}'.format(i), 'bench', stamp, stamp) for i in range(n))
+    )
+    conn.commit()
+
+
+def per_call(fn, args: list) -> float:
+    '''
+    Среднее время одного вызова fn(*a) для a из args, в микросекундах
+    '''
+    t0 = time.perf_counter()
+    for a in args:
+        fn(*a)
+    return (time.perf_counter() - t0) / len(args) * 1e6
+
+
+def bench_lookup(sizes=(1000, 10000, 100000, 1000000), calls=2000):
+    '''
+    Задержка get_card / has_card / update_card / delete_card (промах) в зависимости от размера БД.
+    При проверке существования по первичному ключу время одного вызова не должно расти с ростом БД
+    '''
+    print('{0: >9}  {1: >12}  {2: >12}  {3: >12}  {4: >12}'.format('cards', 'get_card,us', 'has_card,us',
+        'update,us', 'delete-miss,us'))
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            with tb.CardList(os.path.join(tmp, 'bench.tdb')) as db:
+                fill_cards(db, n)
+                ids = [(random.randint(1, n),) for _ in range(calls)]
+                res = (
+                    per_call(db.get_card, ids),
+                    per_call(db.has_card, ids),
+                    per_call(db.update_card, [(i, 'comment', 'upd') for (i,) in ids]),
+                    per_call(db.delete_card, [(n + i,) for (i,) in ids]),
+                )
+        print('{0: >9}  {1: >12.1f}  {2: >12.1f}  {3: >12.1f}  {4: >12.1f}'.format(n, *res))
+
+
+def bench_search(sizes=(1000, 100000), calls=50):
+    '''
+    Время одного поиска по подстроке (LIKE) и по полнотекстовому индексу (FTS5)
+    '''
+    print('{0: >9}  {1: >12}  {2: >12}'.format('cards', 'like,ms', 'fts,ms'))
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            with tb.CardList(os.path.join(tmp, 'bench.tdb')) as db:
+                fill_cards(db, n)
+                patterns = [('Name {0}'.format(random.randint(1, n)),) for _ in range(calls)]
+                res = (
+                    per_call(db.search, patterns) / 1000,
+                    per_call(lambda p: db.search(p, mode='fts'), patterns) / 1000,
+                )
+        print('{0: >9}  {1: >12.2f}  {2: >12.2f}'.format(n, *res))
+
+
+def gen_cards(n: int):
+    '''
+    Генератор n карточек для замеров записи
+    '''
+    for i in range(n):
+        yield {'name': 'Name {0}'.format(i), 'tlf1': '8912{0:0>7}'.format(i), 'job': 'Neil Ltd', 'comment': 'bench'}
+
+
+def bench_bulk(n=100000, single=2000):
+    '''
+    Скорость записи (строк/с): new_card по одной карточке и new_cards пачками
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        with tb.CardList(os.path.join(tmp, 'bench.tdb')) as db:
+            t0 = time.perf_counter()
+            for crd in gen_cards(single):
+                db.new_card(crd)
+            print('{0: <32} {1: >10.0f} rows/s'.format('new_card', single / (time.perf_counter() - t0)))
+            for batch_size, defer in [(1000, False), (10000, False), (10000, True)]:
+                t0 = time.perf_counter()
+                ids, errors = db.new_cards(gen_cards(n), batch_size=batch_size, defer_indexes=defer)
+                print('{0: <32} {1: >10.0f} rows/s'.format(
+                    'new_cards batch={0} defer={1}'.format(batch_size, defer), len(ids) / (time.perf_counter() - t0)))
+
+
+def bench_io(n=100000):
+    '''
+    Скорость потоковой выгрузки и загрузки (строк/с) для форматов csv, jsonl и vcf
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        with tb.CardList(os.path.join(tmp, 'bench.tdb')) as db:
+            db.new_cards(gen_cards(n), batch_size=10000, defer_indexes=True)
+            for fmt in tb.FILE_FORMATS:
+                filename = os.path.join(tmp, 'cards.' + fmt)
+                count, export_rate = db.export_file(filename)
+                with tb.CardList(os.path.join(tmp, fmt + '.tdb')) as db2:
+                    count, errors, import_rate = db2.import_file(filename)
+                print('{0: <6} export {1: >10.0f} rows/s   import {2: >10.0f} rows/s'.format(fmt, export_rate, import_rate))
+
+
+def bench_paging(n=200000, page_size=500):
+    '''
+    Пиковая память Python при просмотре всех карточек: search() целиком и iter_search() страницами
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        with tb.CardList(os.path.join(tmp, 'bench.tdb')) as db:
+            fill_cards(db, n)
+            for name, fn in [('search', lambda: len(db.search('Name'))),
+                    ('iter_search', lambda: sum(1 for _ in db.iter_search('Name', page_size=page_size)))]:
+                tracemalloc.start()
+                t0 = time.perf_counter()
+                count = fn()
+                elapsed = time.perf_counter() - t0
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print('{0: <12} {1: >8} cards  {2: >8.1f} s  peak {3: >8.1f} MB'.format(name, count, elapsed, peak / 2**20))
+
+
+def bench_cache(n=100000, hot=2000, calls=20000):
+    '''
+    Задержка get_card для "горячего" набора карточек без кэша и с кэшем
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'bench.tdb')
+        with tb.CardList(filename) as db:
+            fill_cards(db, n)
+        ids = [(random.randint(1, hot),) for _ in range(calls)]
+        for cache_size in [0, hot]:
+            with tb.CardList(filename, cache_size=cache_size) as db:
+                res = per_call(db.get_card, ids)
+                print('cache_size={0: <6} get_card {1: >8.1f} us  {2}'.format(cache_size, res, db.cache_stats()))
+
+
+def bench_async(n=100000, requests=2000, concurrency=64):
+    '''
+    Нагрузочный тест из asyncio: requests запросов (поиск по индексу + get_card) при concurrency
+    одновременных задачах. Сравнивается вызов синхронного CardList прямо из цикла событий и
+    AsyncCardList. Кроме запросов в секунду измеряется наибольшая задержка цикла событий
+    '''
+    async def run(get_card, search):
+        lag, stop = [0.0], asyncio.Event()
+
+        async def ticker():
+            # Задача, которая должна просыпаться каждую миллисекунду
+            while not stop.is_set():
+                t = time.perf_counter()
+                await asyncio.sleep(0.001)
+                lag[0] = max(lag[0], time.perf_counter() - t - 0.001)
+
+        async def worker(count):
+            for _ in range(count):
+                found = await search('8912{0:0>7}'.format(random.randint(1, n)))
+                if found:
+                    await get_card(found[0]['id'])
+
+        tick = asyncio.ensure_future(ticker())
+        t0 = time.perf_counter()
+        await asyncio.gather(*[worker(requests // concurrency) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - t0
+        stop.set()
+        await tick
+        return requests / elapsed, lag[0] * 1000
+
+    async def main(filename):
+        db = tb.CardList(filename)
+
+        async def sync_get(i):
+            return db.get_card(i)
+
+        async def sync_search(p):
+            return db.search(p, mode='fts', limit=10)
+
+        rate, lag = await run(sync_get, sync_search)
+        print('{0: <14} {1: >8.0f} req/s   max loop lag {2: >8.1f} ms'.format('CardList', rate, lag))
+        db.close()
+        async with tb.AsyncCardList(filename) as adb:
+            rate, lag = await run(adb.get_card, lambda p: adb.search(p, mode='fts', limit=10))
+        print('{0: <14} {1: >8.0f} req/s   max loop lag {2: >8.1f} ms'.format('AsyncCardList', rate, lag))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'bench.tdb')
+        with tb.CardList(filename) as db:
+            db.new_cards(gen_cards(n), batch_size=10000, defer_indexes=True)
+        asyncio.run(main(filename))
+
+
+def bench_statements(n=100000, calls=5000):
+    '''
+    Цена разбора запроса: запрос, собранный через str.format (новый текст на каждое значение,
+    sqlite3 разбирает и планирует его заново), против неизменного параметризованного запроса из
+    tb.SQL (берётся из кэша разобранных запросов соединения)
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        with tb.CardList(os.path.join(tmp, 'bench.tdb')) as db:
+            fill_cards(db, n)
+            conn = db._connect()
+            ids = [(random.randint(1, n),) for _ in range(calls)]
+            pats = [('Name {0}'.format(random.randint(1, n)),) for _ in range(calls // 50)]
+            like = " OR ".join(["({0} LIKE '%{{0}}%')".format(i) for i in tb._LIKE_KEYS])
+            cases = [
+                ('get_card  str.format', ids, lambda i: conn.execute("SELECT * FROM cards WHERE id = {0};".format(i)).fetchone()),
+                ('get_card  parameters', ids, lambda i: conn.execute(tb.SQL['get_card'], (i,)).fetchone()),
+                ('search    str.format', pats, lambda p: conn.execute(
+                    "SELECT * FROM cards WHERE {0} LIMIT 10;".format(like.format(p))).fetchall()),
+                ('search    parameters', pats, lambda p: conn.execute(tb.SQL['search'], db._like_params(p) + [10]).fetchall()),
+            ]
+            for name, args, fn in cases:
+                print('{0: <22} {1: >10.1f} us'.format(name, per_call(fn, args)))
+
+
+def gen_names(n: int, seed: int = 1):
+    '''
+    Генератор n случайных ФИО из слогов: фамилии и имена заметно разнообразнее реальных частот,
+    но повторяются, как в настоящем справочнике
+    '''
+    rnd = random.Random(seed)
+    syl = ['ка', 'ло', 'ми', 'ре', 'ва', 'ни', 'до', 'ру', 'се', 'та', 'бо', 'ле', 'зи', 'па', 'го', 'фе', 'шу', 'ко']
+    ends = ['ов', 'ев', 'ин', 'ский', 'енко', 'ук', 'ман']
+    first = ['Иван', 'Пётр', 'Анна', 'Мария', 'Сергей', 'Ольга', 'Дмитрий', 'Елена', 'Алексей', 'Наталья',
+        'Михаил', 'Татьяна', 'Андрей', 'Ирина', 'Николай', 'Светлана']
+    for _ in range(n):
+        last = ''.join([rnd.choice(syl) for _ in range(rnd.randint(1, 3))]) + rnd.choice(ends)
+        yield '{0} {1}'.format(last.capitalize(), rnd.choice(first))
+
+
+def exact_fuzzy(db: tb.CardList, queries: list, threshold: float = 0.45, limit: int = 20) -> list:
+    '''
+    Точный ответ search_fuzzy перебором всех имён: для каждого запроса limit лучших похожестей
+    '''
+    qtri = [tb.trigrams(tb.fuzzy_key(i)) for i in queries]
+    tops = [[] for _ in queries]
+    for key, in db.any_req("SELECT key FROM fuzzy_names;"):
+        ctri = tb.trigrams(key)
+        for i, tris in enumerate(qtri):
+            score = 2 * len(tris & ctri) / (len(tris) + len(ctri))
+            if score<threshold:
+                continue
+            if len(tops[i])<limit:
+                heapq.heappush(tops[i], score)
+            elif score>tops[i][0]:
+                heapq.heapreplace(tops[i], score)
+    return [sorted(i, reverse=True) for i in tops]
+
+
+def bench_fuzzy(sizes=(10000, 100000, 1000000), calls=200, checks=20):
+    '''
+    Время нечёткого поиска по имени: запрос - имя из БД латиницей и с опечаткой. Полнота - доля
+    мест в ответе на checks запросов, где похожесть не ниже, чем в точном ответе перебором
+    '''
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            with tb.CardList(os.path.join(tmp, 'bench.tdb')) as db:
+                db.new_cards(({'name': i} for i in gen_names(n)), batch_size=10000, defer_indexes=True)
+                names = random.sample(list(gen_names(n)), calls)
+                # Латиница вместо кириллицы и пропущенная буква в фамилии
+                queries = [(tb.fuzzy_key(i)[:3] + tb.fuzzy_key(i)[4:],) for i in names]
+                res = per_call(db.search_fuzzy, queries) / 1000
+                hits = total = 0
+                for (query,), exact in zip(queries, exact_fuzzy(db, [i[0] for i in queries[:checks]])):
+                    found = [score for score, _ in db.search_fuzzy(query)]
+                    hits += sum(1 for score, best in zip(found, exact) if score>=best - 1e-9)
+                    total += len(exact)
+        print('{0: >9} cards  search_fuzzy {1: >8.2f} ms   recall {2: >5.3f}'.format(n, res, hits / max(total, 1)))
+
+
+def bench_instrument(n=100000, calls=20000):
+    '''
+    Цена замеров: задержка get_card и поиска по индексу без instrument и с ним
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'bench.tdb')
+        with tb.CardList(filename) as db:
+            fill_cards(db, n)
+        ids = [(random.randint(1, n),) for _ in range(calls)]
+        phones = [('8912{0:0>7}'.format(random.randint(1, n)),) for _ in range(calls // 10)]
+        for instrument in [False, True]:
+            with tb.CardList(filename, instrument=instrument, slow_query=None) as db:
+                print('instrument={0: <6} get_card {1: >8.1f} us   find_by_phone {2: >8.1f} us'.format(
+                    str(instrument), per_call(db.get_card, ids), per_call(db.find_by_phone, phones)))
+
+
+def writer_proc(filename: str, proc: int, count: int) -> tuple:
+    '''
+    Процесс-писатель для bench_writers: добавляет count карточек по одной, затем меняет каждую.
+    Вернет (id добавленных карточек, время работы в секундах)
+    '''
+    t0 = time.perf_counter()
+    ids = []
+    with tb.CardList(filename) as db:
+        for i in range(count):
+            db.new_card({'name': 'writer {0} card {1}'.format(proc, i), 'tlf1': '8912{0:0>3}{1:0>4}'.format(proc, i)})
+            ids.append(db.any_req("SELECT max(id) FROM cards WHERE name = 'writer {0} card {1}';".format(proc, i))[0][0])
+        for card_id in ids:
+            if db.update_card(card_id, 'comment', 'updated by {0}'.format(proc)):
+                raise RuntimeError('update_card({0}) failed'.format(card_id))
+    return ids, time.perf_counter() - t0
+
+
+def bench_writers(procs=(1, 2, 4, 8), count=500):
+    '''
+    Нагрузочный тест одновременной записи из нескольких процессов в один новый файл БД (схема
+    создаётся ими же наперегонки). Проверяет, что ни одна запись не потеряна и не упала с
+    "database is locked", и выводит общую скорость записи (new_card + update_card в секунду)
+    '''
+    for n in procs:
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'bench.tdb')
+            t0 = time.perf_counter()
+            with ProcessPoolExecutor(max_workers=n) as pool:
+                res = list(pool.map(writer_proc, [filename] * n, range(n), [count] * n))
+            elapsed = time.perf_counter() - t0
+            ids = [i for proc_ids, _ in res for i in proc_ids]
+            with tb.CardList(filename) as db:
+                assert len(set(ids))==n * count, 'duplicate ids'
+                assert db.row_count()==n * count, 'lost inserts'
+                updated = db.any_req("SELECT count(*) FROM cards WHERE comment LIKE 'updated by %';")[0][0]
+                assert updated==n * count, 'lost updates'
+                assert len(db.find_by_phone('8912{0:0>3}{1:0>4}'.format(n - 1, count - 1)))==1, 'lost phone index'
+                found = db.search_fuzzy('writer {0} card {1}'.format(n - 1, count - 1), limit=1)
+                assert found and found[0][1]['id']==res[-1][0][-1], 'wrong fuzzy index'
+        print('{0: >2} processes  {1: >8.0f} writes/s  (max process time {2: .1f} s)'.format(
+            n, 2 * n * count / elapsed, max(i[1] for i in res)))
+
+
+def bench_federation(shards=8, n=25000, calls=20):
+    '''
+    Поиск по подстроке и по телефону: одна БД из shards*n карточек против shards файлов по n
+    карточек в CardListFederation
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        with tb.CardList(os.path.join(tmp, 'single.tdb')) as db:
+            db.new_cards(gen_contacts(shards * n), batch_size=10000, defer_indexes=True)
+        os.mkdir(os.path.join(tmp, 'shards'))
+        for i in range(shards):
+            with tb.CardList(os.path.join(tmp, 'shards', 'region{0}.tdb'.format(i))) as db:
+                db.new_cards(gen_contacts(n, seed=i + 1), batch_size=10000, defer_indexes=True)
+        names = [(i['name'],) for i in gen_contacts(calls, seed=100)]
+        phones = [(i['tlf1'],) for i in gen_contacts(calls, seed=101)]
+        with tb.CardList(os.path.join(tmp, 'single.tdb')) as db:
+            print('{0: <24} search {1: >8.1f} ms   find_by_phone {2: >8.2f} ms'.format('one file',
+                per_call(db.search, names) / 1000, per_call(db.find_by_phone, phones) / 1000))
+        with tb.CardListFederation(os.path.join(tmp, 'shards')) as fed:
+            print('{0: <24} search {1: >8.1f} ms   find_by_phone {2: >8.2f} ms'.format('{0} shards'.format(shards),
+                per_call(fed.search, names) / 1000, per_call(fed.find_by_phone, phones) / 1000))
+
+
+def bench_cards(n=1000000):
+    '''
+    Память и время на чтение n карточек одним списком: словарь на строку (как было), Card и Card
+    только с полями name и tlf1
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        with tb.CardList(os.path.join(tmp, 'bench.tdb')) as db:
+            fill_cards(db, n)
+            conn = db._connect()
+            for name, fn in [
+                    ('dict per row', lambda: [dict(zip(tb.CARD_KEYS, i)) for i in conn.execute(tb.SQL['page'], (-1, n)).fetchall()]),
+                    ('Card', lambda: db.search_page('', page_size=n)[0]),
+                    ('Card name, tlf1', lambda: db.search_page('', page_size=n, columns=['name', 'tlf1'])[0])]:
+                # Время - без tracemalloc, который замедляет каждое выделение памяти
+                t0 = time.perf_counter()
+                cards = fn()
+                elapsed = time.perf_counter() - t0
+                del cards
+                tracemalloc.start()
+                cards = fn()
+                size = tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+                del cards
+                print('{0: <16} {1: >8} cards  {2: >6.2f} s  held {3: >8.1f} MB'.format(name, n, elapsed, size / 2**20))
+
+
+def bench_dedup(sizes=(100000, 1000000), share=0.02):
+    '''
+    Поиск дублей: к n карточкам добавляется доля share копий - имя в другом регистре, номер из tlf1
+    записан в tlf2 в другом формате. Выводится время find_duplicates, сколько копий найдено и сколько
+    найденных групп - не копии
+    '''
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            with tb.CardList(os.path.join(tmp, 'bench.tdb')) as db:
+                cards = list(gen_contacts(n))
+                rnd = random.Random(7)
+                copies = rnd.sample(range(n), int(n * share))
+                cards += [{'name': cards[i]['name'].upper(), 'tlf2': '+' + tb.normalize_phone(cards[i]['tlf1']),
+                    'comment': 'imported'} for i in copies]
+                ids, errors = db.new_cards(cards, batch_size=10000, defer_indexes=True)
+                del cards
+                t0 = time.perf_counter()
+                groups = [set(g) for _, g in db.find_duplicates()]
+                elapsed = time.perf_counter() - t0
+                copy_of = {ids[i]: ids[n + k] for k, i in enumerate(copies)}
+                found = sum(1 for g in groups if any(copy_of.get(i) in g for i in g))
+        print('{0: >9} cards  find_duplicates {1: >6.1f} s  copies found {2}/{3}  other groups {4}'.format(
+            n, elapsed, found, len(copies), len(groups) - found))
+
+
+def bench_backup(n=100000, steps=(64, 1024, -1), share=0.5):
+    '''
+    Горячая копия и сжатие файла БД из n карточек. backup - с разным числом страниц за шаг, пока
+    другой поток пишет в ту же БД (выводится, сколько записей он успел сделать за время копирования).
+    compact - после удаления доли share карточек: размер файла до и после
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'bench.tdb')
+        with tb.CardList(filename) as db:
+            db.new_cards(gen_contacts(n), batch_size=10000, defer_indexes=True)
+            stop, writes = threading.Event(), [0]
+
+            def writer():
+                with tb.CardList(filename) as wdb:
+                    while not stop.is_set():
+                        wdb.new_card({'name': 'Писатель', 'tlf1': '+7 900 000-00-00'})
+                        writes[0] += 1
+
+            thread = threading.Thread(target=writer)
+            thread.start()
+            try:
+                for step in steps:
+                    dest = os.path.join(tmp, 'copy{0}.tdb'.format(step))
+                    before, t0 = writes[0], time.perf_counter()
+                    pages, rate = db.backup(dest, pages_per_step=step)
+                    elapsed = time.perf_counter() - t0
+                    print('backup  pages_per_step {0: >5}  {1: >6} pages  {2: >7.1f} MB/s  {3: >7.3f} s  '
+                        'writes meanwhile {4}'.format(step, pages, rate, elapsed, writes[0] - before))
+            finally:
+                stop.set()
+                thread.join()
+
+            size = os.path.getsize(filename)
+            ids = db.avail_id()
+            conn = db._connect()
+            conn.execute("BEGIN IMMEDIATE;")
+            conn.executemany(tb.SQL['delete_card'], [(i,) for i in ids[:int(len(ids) * share)]])
+            conn.commit()
+            t0 = time.perf_counter()
+            pages, rate = db.compact()
+            elapsed = time.perf_counter() - t0
+            print('compact {0: >6} pages freed  {1: >7.1f} MB/s  {2: >7.3f} s  file {3:.1f} -> {4:.1f} MB'.format(
+                pages, rate, elapsed, size / 1048576, os.path.getsize(filename) / 1048576))
+
+
+def bench_replica(n=100000, calls=2000, refresh=1.0):
+    '''
+    Задержка чтения из файла и из копии БД в памяти (replica) на n карточках: get_card,
+    find_by_phone, search fts и search_fuzzy (p50/p99 в микросекундах), время загрузки копии и
+    через сколько запись в файл видна в копии
+    '''
+    rnd = random.Random(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'bench.tdb')
+        with tb.CardList(filename) as db:
+            ids, _ = db.new_cards(gen_contacts(n), batch_size=10000, defer_indexes=True)
+            sample = [db.get_card(i) for i in rnd.sample(ids, calls)]
+        ops = {
+            'get_card': ('get_card', [(i['id'],) for i in sample]),
+            'find_by_phone': ('find_by_phone', [(i['tlf1'],) for i in sample]),
+            'search fts': ('search', [(i['name'].split()[0], 'fts', True, 20) for i in sample[:calls // 10]]),
+            'search_fuzzy': ('search_fuzzy', [(i['name'][:-1],) for i in sample[:calls // 100]]),
+        }
+        res = {}
+        for replica in [None, refresh]:
+            t0 = time.perf_counter()
+            db = tb.CardList(filename, replica=replica)
+            opened = time.perf_counter() - t0
+            for name, (method, args) in ops.items():
+                getattr(db, method)(*args[0])
+                res[name, replica] = latency(getattr(db, method), args)
+            if replica is not None:
+                db.update_fields(ids[0], {'comment': 'replica'})
+                t0 = time.perf_counter()
+                while db.get_card(ids[0])['comment']!='replica':
+                    time.sleep(0.01)
+                print('replica: load {0:.2f} s, write visible after {1:.2f} s (refresh {2:g} s)'.format(
+                    opened, time.perf_counter() - t0, refresh))
+            db.close()
+    print('{0: <14} {1: >14} {2: >14} {3: >14} {4: >14}'.format('', 'disk p50,us', 'disk p99,us',
+        'memory p50,us', 'memory p99,us'))
+    for name in ops:
+        disk, mem = res[name, None], res[name, refresh]
+        print('{0: <14} {1: >14} {2: >14} {3: >14} {4: >14}'.format(name, disk['p50_us'], disk['p99_us'],
+            mem['p50_us'], mem['p99_us']))
+
+
+# Программа для bench_startup: время импорта модуля, конструктора CardList и первого get_card
+_STARTUP = '''
+import sys, time
+t0 = time.perf_counter()
+sys.path.insert(0, {path!r})
+import telfbook as tb
+t1 = time.perf_counter()
+db = tb.CardList({filename!r}, lazy={lazy})
+t2 = time.perf_counter()
+db.get_card(1)
+t3 = time.perf_counter()
+print(t1 - t0, t2 - t1, t3 - t2)
+'''
+
+
+def bench_startup(n=100000, runs=20):
+    '''
+    Время от запуска программы до первого get_card (медиана по runs запускам нового процесса):
+    импорт telfbook, конструктор CardList (обычный и lazy) и сам get_card
+    '''
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'bench.tdb')
+        with tb.CardList(filename) as db:
+            fill_cards(db, n)
+        path = os.path.dirname(os.path.abspath(tb.__file__))
+        for lazy in [False, True]:
+            code = _STARTUP.format(path=path, filename=filename, lazy=lazy)
+            res = sorted([[float(i) * 1000 for i in subprocess.run([sys.executable, '-c', code],
+                capture_output=True, text=True, check=True).stdout.split()] for _ in range(runs)], key=sum)
+            med = res[len(res) // 2]
+            print('lazy={0: <6} import {1: >6.1f} ms  CardList() {2: >6.2f} ms  first get_card {3: >6.2f} ms  '
+                'total {4: >6.1f} ms'.format(str(lazy), *med, sum(med)))
+
+
+_SURNAMES = ['Иванов', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Петров', 'Соколов', 'Михайлов',
+    'Новиков', 'Фёдоров', 'Морозов', 'Волков', 'Алексеев', 'Лебедев', 'Семёнов', 'Егоров', 'Павлов',
+    'Козлов', 'Степанов', 'Николаев', 'Орлов', 'Андреев', 'Макаров', 'Никитин', 'Захаров', 'Зайцев',
+    'Соловьёв', 'Борисов', 'Яковлев', 'Григорьев', 'Романов', 'Воробьёв', 'Сергеев', 'Кузьмин', 'Фролов',
+    'Александров', 'Дмитриев', 'Королёв', 'Гусев', 'Киселёв', 'Ильин', 'Максимов', 'Поляков', 'Сорокин',
+    'Виноградов', 'Ковалёв', 'Белов', 'Медведев', 'Антонов', 'Тарасов', 'Жуков', 'Баранов', 'Филиппов',
+    'Комаров', 'Давыдов', 'Беляев', 'Герасимов', 'Богданов', 'Осипов', 'Сидоров', 'Матвеев', 'Титов',
+    'Марков', 'Миронов', 'Крылов', 'Куликов', 'Карпов', 'Власов', 'Мельников', 'Денисов', 'Гаврилов',
+    'Тихонов', 'Казаков', 'Афанасьев', 'Данилов', 'Савельев', 'Тимофеев', 'Фомин', 'Чернов', 'Абрамов',
+    'Мартынов', 'Ефимов', 'Федотов', 'Щербаков', 'Назаров', 'Калинин', 'Исаев', 'Чернышёв', 'Быков',
+    'Маслов', 'Родионов', 'Коновалов', 'Лазарев', 'Воронин', 'Климов', 'Филатов', 'Пономарёв', 'Голубев',
+    'Кудрявцев', 'Прохоров', 'Наумов', 'Потапов', 'Журавлёв', 'Овчинников', 'Трофимов', 'Леонов',
+    'Соболев', 'Ермаков', 'Колесников', 'Гончаров', 'Емельянов', 'Никифоров', 'Грачёв', 'Котов',
+    'Гришин', 'Ефремов', 'Архипов', 'Громов', 'Кириллов', 'Малышев', 'Панов', 'Моисеев', 'Румянцев',
+    'Акимов', 'Кондратьев', 'Бирюков', 'Горбунов', 'Анисимов', 'Ерёмин', 'Тихомиров', 'Галкин',
+    'Лукьянов', 'Михеев', 'Скворцов', 'Юдин', 'Белоусов', 'Нестеров', 'Симонов', 'Прокофьев',
+    'Харитонов', 'Князев', 'Цветков', 'Левин', 'Митрофанов', 'Воронов', 'Аксёнов', 'Софронов',
+    'Мальцев', 'Логинов', 'Горшков', 'Савин', 'Краснов', 'Майоров', 'Демидов', 'Елисеев', 'Рыбаков',
+    'Сафонов', 'Плотников', 'Дёмин', 'Хохлов', 'Фадеев', 'Молчанов', 'Игнатов', 'Литвинов', 'Ершов',
+    'Ушаков', 'Дементьев', 'Рябов', 'Мухин', 'Калашников', 'Леонтьев', 'Лобанов', 'Кузин', 'Корнилов',
+    'Евдокимов', 'Бородин', 'Платонов', 'Некрасов', 'Балашов', 'Бобров', 'Жданов', 'Блинов', 'Игнатьев',
+    'Коротков', 'Муравьёв', 'Крюков', 'Беляков', 'Богомолов', 'Дроздов', 'Лавров', 'Зуев', 'Петухов',
+    'Ларин', 'Никулин', 'Серов', 'Терентьев', 'Зотов', 'Устинов', 'Фокин', 'Самойлов', 'Константинов',
+    'Сахаров', 'Шишкин', 'Самсонов', 'Черкасов', 'Чистяков', 'Носов', 'Спиридонов', 'Карасёв', 'Авдеев',
+    'Воронцов', 'Зверев', 'Владимиров', 'Селезнёв', 'Нечаев', 'Кудряшов', 'Седов', 'Фирсов', 'Андрианов',
+    'Панин', 'Головин', 'Терехов', 'Ульянов', 'Шестаков', 'Агеев', 'Никонов', 'Селиванов', 'Баженов',
+    'Гордеев', 'Кожевников', 'Пахомов', 'Зимин', 'Костин', 'Широков', 'Филимонов', 'Ларионов', 'Овсянников',
+    'Сазонов', 'Суворов', 'Нефёдов', 'Корнеев', 'Трифонов', 'Кулагин', 'Шевченко', 'Бондаренко',
+    'Коваленко', 'Кравченко', 'Ткаченко', 'Савченко', 'Руденко', 'Марченко', 'Ковальчук', 'Полищук',
+    'Мельничук', 'Островский', 'Вишневский', 'Соколовский', 'Данилевский', 'Покровский', 'Успенский']
+_MALE = ['Александр', 'Дмитрий', 'Максим', 'Сергей', 'Андрей', 'Алексей', 'Артём', 'Илья', 'Кирилл',
+    'Михаил', 'Никита', 'Матвей', 'Роман', 'Егор', 'Арсений', 'Иван', 'Денис', 'Евгений', 'Тимофей',
+    'Владимир', 'Павел', 'Николай', 'Юрий', 'Олег', 'Виктор']
+_FEMALE = ['Анастасия', 'Мария', 'Анна', 'Виктория', 'Екатерина', 'Наталья', 'Марина', 'Полина', 'Дарья',
+    'Алиса', 'Ольга', 'Елена', 'Татьяна', 'Ирина', 'Светлана', 'Юлия', 'Ксения', 'Людмила', 'Галина',
+    'Вера', 'Надежда', 'Софья', 'Алёна', 'Евгения', 'Валентина']
+_PATRONYMIC = ['Александров', 'Дмитриев', 'Сергеев', 'Андреев', 'Алексеев', 'Михайлов', 'Иванов',
+    'Владимиров', 'Павлов', 'Николаев', 'Юрьев', 'Викторов', 'Олегов', 'Евгеньев', 'Петров']
+_CITIES = ['Москва', 'Санкт-Петербург', 'Новосибирск', 'Екатеринбург', 'Казань', 'Нижний Новгород',
+    'Челябинск', 'Самара', 'Омск', 'Ростов-на-Дону', 'Уфа', 'Красноярск', 'Пермь', 'Воронеж']
+_STREETS = ['ул. Ленина', 'ул. Советская', 'ул. Мира', 'пр. Победы', 'ул. Садовая', 'ул. Гагарина',
+    'ул. Молодёжная', 'ул. Школьная', 'ул. Лесная', 'пер. Почтовый', 'ул. Набережная', 'ш. Энтузиастов']
+_JOBS = ['ООО "Ромашка"', 'АО "Стройтрест"', 'ИП Сидоров', 'МБОУ СОШ № 12', 'ГБУЗ ГКБ № 1',
+    'ПАО "Сбербанк"', 'ООО "Вектор"', 'Почта России', '']
+_COMMENTS = ['моб.', 'раб.', 'дом.', 'жена', 'муж', 'мама', 'папа', 'факс', '']
+_DOMAINS = ['mail.ru', 'yandex.ru', 'gmail.com', 'bk.ru', 'list.ru', 'inbox.ru']
+
+
+def gen_phone(rnd: random.Random) -> str:
+    '''
+    Случайный номер в одном из форматов, которыми номера записывают на практике
+    '''
+    code, num = rnd.choice(['912', '916', '903', '921', '985', '495', '812', '343']), rnd.randint(0, 9999999)
+    a, b, c = '{0:0>7}'.format(num)[:3], '{0:0>7}'.format(num)[3:5], '{0:0>7}'.format(num)[5:]
+    return rnd.choice([
+        '+7 ({0}) {1}-{2}-{3}', '8 ({0}) {1}-{2}-{3}', '8-{0}-{1}-{2}-{3}', '8{0}{1}{2}{3}',
+        '+7{0}{1}{2}{3}', '+7 {0} {1} {2} {3}', '{1}-{2}-{3}',
+    ]).format(code, a, b, c)
+
+
+def gen_contacts(n: int, seed: int = 1):
+    '''
+    Генератор n правдоподобных карточек: ФИО на кириллице (с отчеством или без), от одного до
+    трёх телефонов в разных форматах, адрес, место работы, почта. При одном и том же seed
+    последовательность карточек одна и та же, поэтому замеры разных версий сравнимы
+    '''
+    rnd = random.Random(seed)
+    for _ in range(n):
+        last = rnd.choice(_SURNAMES)
+        if rnd.random() < 0.5:
+            first, patr = rnd.choice(_MALE), rnd.choice(_PATRONYMIC) + 'ич'
+        else:
+            # Женская форма фамилии: -ова, -ина, -ская; -енко и -ук не меняются
+            first, patr = rnd.choice(_FEMALE), rnd.choice(_PATRONYMIC) + 'на'
+            last = last[:-2] + 'ая' if last.endswith('ий') else last if last.endswith(('ко', 'ук')) else last + 'а'
+        crd = {'name': ' '.join([last, first, patr] if rnd.random() < 0.7 else [last, first])}
+        for i in range(1, rnd.choice([1, 1, 1, 2, 2, 3]) + 1):
+            crd['tlf{0}'.format(i)] = gen_phone(rnd)
+            crd['comment{0}'.format(i)] = rnd.choice(_COMMENTS)
+        crd['adr'] = 'г. {0}, {1}, д. {2}, кв. {3}'.format(rnd.choice(_CITIES), rnd.choice(_STREETS),
+            rnd.randint(1, 150), rnd.randint(1, 300))
+        crd['job'] = rnd.choice(_JOBS)
+        if rnd.random() < 0.6:
+            crd['mail'] = '{0}{1}@{2}'.format(tb.fuzzy_key(first).replace(' ', ''), rnd.randint(1, 9999),
+                rnd.choice(_DOMAINS))
+        yield crd
+
+
+def latency(fn, args: list) -> dict:
+    '''
+    Вызывает fn(*a) для каждого a из args, засекая каждый вызов. Вернет словарь: число вызовов,
+    вызовов в секунду и задержки p50/p99 в микросекундах
+    '''
+    times = []
+    for a in args:
+        t0 = time.perf_counter()
+        fn(*a)
+        times.append(time.perf_counter() - t0)
+    total = sum(times) or 1e-9
+    times.sort()
+    pct = lambda p: round(times[min(len(times) - 1, int(len(times) * p))] * 1e6, 1)
+    return {'calls': len(times), 'ops_per_sec': round(len(times) / total, 1), 'p50_us': pct(0.5), 'p99_us': pct(0.99)}
+
+
+def suite_size(n: int, calls: int = 1000, seed: int = 1) -> dict:
+    '''
+    Замеры основных операций CardList на БД из n карточек gen_contacts(n, seed). Запускается в
+    отдельном процессе, поэтому пиковый RSS относится только к этому размеру БД
+    '''
+    rnd = random.Random(seed)
+    res = {'rows': n, 'ops': {}}
+    ops = res['ops']
+    with tempfile.TemporaryDirectory() as tmp:
+        with tb.CardList(os.path.join(tmp, 'bench.tdb')) as db:
+            # Массовая загрузка: new_cards пачками по batch строк, задержка - на одну пачку. Пачки
+            #    берутся из генератора по одной, чтобы пиковый RSS был библиотеки, а не тестовых данных
+            batch = min(10000, max(1, n // 10))
+            contacts = gen_contacts(n, seed)
+            chunks = iter(lambda: list(itertools.islice(contacts, batch)), [])
+            ops['bulk_insert'] = latency(lambda chunk: db.new_cards(chunk, batch_size=batch), ((i,) for i in chunks))
+            ops['bulk_insert']['rows_per_sec'] = round(ops['bulk_insert']['ops_per_sec'] * batch, 1)
+            names = [i['name'] for i in gen_contacts(calls, seed + 1)]
+            ids = [(rnd.randint(1, n),) for _ in range(calls)]
+            ops['new_card'] = latency(db.new_card, [(i,) for i in gen_contacts(calls, seed + 2)])
+            ops['get_card'] = latency(db.get_card, ids)
+            ops['update_card'] = latency(db.update_card, [(i, 'comment', 'upd {0}'.format(i)) for (i,) in ids])
+            # Поиск - полный просмотр таблицы, поэтому вызовов меньше
+            few = max(10, calls // 20)
+            ops['search_short'] = latency(lambda p: db.search(p, limit=50), [(i.split()[0][:2],) for i in names[:few]])
+            ops['search_long'] = latency(lambda p: db.search(p, limit=50), [(i,) for i in names[:few]])
+            ops['search_nomatch'] = latency(lambda p: db.search(p, limit=50),
+                [('Щъщ{0}'.format(i),) for i in range(few)])
+            ops['row_count'] = latency(db.row_count, [()] * few)
+            ops['delete_card'] = latency(db.delete_card, list(dict.fromkeys(ids)))
+            # avail_id без ограничения читает id всех карточек, поэтому вызовов совсем мало
+            ops['avail_id'] = latency(db.avail_id, [()] * max(3, calls // 200))
+            ops['avail_id_50'] = latency(lambda: db.avail_id(50), [()] * calls)
+    if resource is not None:
+        # В Linux ru_maxrss - в килобайтах, в macOS - в байтах
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        res['peak_rss_mb'] = round(rss / (2**20 if sys.platform=='darwin' else 2**10), 1)
+    else:
+        res['peak_rss_mb'] = None
+    return res
+
+
+def bench_suite(sizes=(1000, 100000, 1000000), calls=1000, seed=1, out=None):
+    '''
+    Воспроизводимый набор замеров для сравнения версий: для каждого размера БД - вызовов в секунду
+    и задержки p50/p99 операций new_card, new_cards, get_card, update_card, delete_card, search
+    (короткий, длинный и отсутствующий шаблон), row_count, avail_id (весь список и первые 50), а также
+    пиковый RSS. Результат - JSON (в файл out или на stdout)
+    '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    report = {
+        'commit': commit,
+        'date': tb.timestamp(),
+        'python': platform.python_version(),
+        'sqlite': tb.sq3.sqlite_version,
+        'platform': platform.platform(),
+        'seed': seed,
+        'calls': calls,
+        'results': [],
+    }
+    for n in sizes:
+        # Каждый размер - в новом процессе, чтобы пиковый RSS не наследовался от предыдущего
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            report['results'].append(pool.submit(suite_size, n, calls, seed).result())
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if out:
+        with open(out, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return report
+
+
+BENCHMARKS = {
+    'lookup': bench_lookup,
+    'search': bench_search,
+    'bulk': bench_bulk,
+    'io': bench_io,
+    'paging': bench_paging,
+    'cache': bench_cache,
+    'async': bench_async,
+    'statements': bench_statements,
+    'fuzzy': bench_fuzzy,
+    'instrument': bench_instrument,
+    'writers': bench_writers,
+    'federation': bench_federation,
+    'cards': bench_cards,
+    'startup': bench_startup,
+    'dedup': bench_dedup,
+    'backup': bench_backup,
+    'replica': bench_replica,
+    'suite': bench_suite,
+}
+
+
+if __name__=='__main__':
+    # python bench_telfbook.py suite [размер ...] [--seed N] [--calls N] [--out файл.json]
+    if sys.argv[1:2]==['suite']:
+        args, opts = sys.argv[2:], {}
+        while '--' in ''.join(args):
+            i = [j.startswith('--') for j in args].index(True)
+            opts[args[i][2:]] = args[i + 1]
+            del args[i:i + 2]
+        bench_suite(sizes=[int(i) for i in args] or (1000, 100000, 1000000), calls=int(opts.get('calls', 1000)),
+            seed=int(opts.get('seed', 1)), out=opts.get('out'))
+        sys.exit()
+    for name in (sys.argv[1:] or [i for i in BENCHMARKS if i!='suite']):
+        print('\n== {0} =='.format(name))
+        BENCHMARKS[name]()
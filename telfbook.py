@@ -3,6 +3,17 @@ import os
 import functools as ft
 import sqlite3 as sq3
 import datetime as dt
+import threading
+import math
+import collections.abc
+import time
+import random
+import bisect
+import zlib
+import heapq
+# asyncio, concurrent.futures, csv, json и logging импортируются в функциях, которым они нужны:
+#    вместе они в десятки раз дольше импорта остального модуля, а короткой программе, которая
+#    только читает карточки, не нужны
 
 # my_keys = ['id', 'name', 'tlf1', 'comment1', 'tlf2', 'comment2', 'tlf3', 'comment3', 'adr', 'job', 
 #      'mail', 'site', 'comment', 'cr_dt', 'upd_dt']
@@ -20,187 +31,2511 @@ def now() -> tuple:
     )
 
 
+def timestamp() -> str:
+    '''
+    Текущие дата и время для полей cr_dt и upd_dt в виде "ГГГГ-ММ-ДД чч:мм:сс" - это формат
+    даты sqlite: строки сортируются по времени и понимаются функциями datetime(), julianday()
+    '''
+    return dt.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def normalize_phone(number: str) -> str:
+    '''
+    Приводит номер телефона к виду "только цифры": "+7 (912) 345-67-89" и "89123456789" дадут
+    "79123456789". Российские номера из 11 цифр с ведущей 8 и 10-значные номера без кода страны
+    приводятся к коду 7. Если цифр в строке нет - вернет пустую строку
+    '''
+    digits = ''.join([i for i in str(number) if i.isdigit()])
+    if len(digits)==11 and digits[0]=='8':
+        digits = '7' + digits[1:]
+    elif len(digits)==10:
+        digits = '7' + digits
+    return digits
+
+
+# Транслитерация кириллицы для нечёткого поиска: "Иванов" и "Ivanov" дают одинаковые триграммы
+_TRANSLIT = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'e', 'ж': 'zh', 'з': 'z', 'и': 'i',
+    'й': 'i', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r', 'с': 's', 'т': 't',
+    'у': 'u', 'ф': 'f', 'х': 'kh', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'shch', 'ъ': '', 'ы': 'y', 'ь': '',
+    'э': 'e', 'ю': 'yu', 'я': 'ya',
+})
+
+
+def fuzzy_key(text: str) -> str:
+    '''
+    Приводит строку к виду для нечёткого сравнения: нижний регистр, кириллица в латинице,
+    все знаки кроме букв и цифр - пробелы
+    '''
+    text = str(text).lower().translate(_TRANSLIT)
+    return ' '.join(''.join([(c if c.isalnum() else ' ') for c in text]).split())
+
+
+def name_block(key: str) -> str:
+    '''
+    Ключ блока для поиска дублей по имени: слова приведённого fuzzy_key имени в алфавитном
+    порядке, поэтому "Иванов Иван" и "Ivan Ivanov" попадают в один блок
+    '''
+    return ' '.join(sorted(key.split()))
+
+
+def trigrams(key: str) -> set:
+    '''
+    Множество триграмм строки, приведённой fuzzy_key. Каждое слово дополняется пробелами
+    (два в начале, один в конце), поэтому начало слова весит больше
+    '''
+    return {w[i:i+3] for w in ['  '+j+' ' for j in key.split()] for i in range(len(w)-2)}
+
+
+@ft.lru_cache(maxsize=65536)
+def word_trigrams(word: str) -> frozenset:
+    '''
+    Триграммы одного слова (см. trigrams) с кэшем: search_fuzzy раз за разом сравнивает с запросом
+    одни и те же слова словаря
+    '''
+    return frozenset(trigrams(word))
+
+
+def trigram_mask(tris: set) -> int:
+    '''
+    Битовая маска множества триграмм (63 бита, чтобы помещалась в INTEGER sqlite): у каждой
+    триграммы свой бит по crc32. Число общих битов двух масок - оценка числа общих триграмм
+    '''
+    mask = 0
+    for i in tris:
+        mask |= 1 << (zlib.crc32(i.encode('utf-8')) % 63)
+    return mask
+
+
+# Поля карточки в порядке столбцов таблицы cards
+CARD_KEYS = ['id', 'name', 'tlf1', 'comment1', 'tlf2', 'comment2', 'tlf3', 'comment3', 'adr', 'job', 
+    'mail', 'site', 'comment', 'cr_dt', 'upd_dt']
+CARD_COLUMNS = tuple(CARD_KEYS)
+
+
+# Поля полнотекстового индекса и их веса для ранжирования bm25
+FTS_COLUMNS = {
+    'name': 10.0, 'tlf1': 5.0, 'comment1': 1.0, 'tlf2': 5.0, 'comment2': 1.0, 'tlf3': 5.0,
+    'comment3': 1.0, 'adr': 2.0, 'job': 2.0, 'mail': 2.0, 'site': 1.0, 'comment': 1.0
+}
+
+# Условие поиска подстроки во всех полях карточки; параметр - шаблон '%...%' для каждого поля
+_LIKE_KEYS = ['name', 'tlf1', 'comment1', 'tlf2', 'comment2', 'tlf3', 'comment3', 'adr', 'job', 
+    'mail', 'site', 'comment', 'cr_dt', 'upd_dt']
+_LIKE_WHERE = "(" + " OR ".join(["("+i+" LIKE ?)" for i in _LIKE_KEYS]) + ")"
+_BM25 = "bm25(cards_fts, {0})".format(', '.join(map(str, FTS_COLUMNS.values())))
+
+# Запросы CardList. Тексты запросов не меняются от вызова к вызову, все значения передаются
+#    параметрами: sqlite3 разбирает каждый запрос один раз и дальше берёт его из кэша соединения.
+#    LIMIT -1 в sqlite означает "без ограничения"
+SQL = {
+    'row_count': "SELECT COUNT(*) FROM cards;",
+    'avail_id': "SELECT id FROM cards ORDER BY id LIMIT ?;",
+    'has_card': "SELECT 1 FROM cards WHERE id = ?;",
+    'get_card': "SELECT * FROM cards WHERE id = ?;",
+    'delete_card': "DELETE FROM cards WHERE id = ?;",
+    'search': "SELECT * FROM cards WHERE " + _LIKE_WHERE + " LIMIT ?;",
+    'search_fts': ("SELECT cards.* FROM cards_fts JOIN cards ON cards.id = cards_fts.rowid "
+        "WHERE cards_fts MATCH ? ORDER BY " + _BM25 + " LIMIT ?;"),
+    'page': "SELECT * FROM cards WHERE id > ? ORDER BY id LIMIT ?;",
+    'page_like': "SELECT * FROM cards WHERE " + _LIKE_WHERE + " AND id > ? ORDER BY id LIMIT ?;",
+    'page_fts': ("SELECT * FROM (SELECT cards.*, " + _BM25 + " AS score FROM cards_fts "
+        "JOIN cards ON cards.id = cards_fts.rowid WHERE cards_fts MATCH ?) "
+        "WHERE (score, id) > (?, ?) ORDER BY score, id LIMIT ?;"),
+    'phone': "SELECT * FROM cards WHERE id IN (SELECT card_id FROM phones WHERE digits = ?) ORDER BY id;",
+    # Совпадение окончания номера - это совпадение начала перевёрнутой строки
+    'phone_suffix': ("SELECT * FROM cards WHERE id IN "
+        "(SELECT card_id FROM phones WHERE rdigits >= ? AND rdigits < ?) ORDER BY id;"),
+    'phones_delete': "DELETE FROM phones WHERE card_id = ? AND slot = ?;",
+    'phones_insert': "INSERT INTO phones (card_id, slot, digits, rdigits) VALUES (?, ?, ?, ?);",
+    'cards_seq': "SELECT seq FROM sqlite_sequence WHERE name = 'cards';",
+    'data_version': "PRAGMA data_version;",
+    'changes': ("SELECT changes.seq, changes.op, changes.card_id, changes.ts, cards.* FROM changes "
+        "LEFT JOIN cards ON cards.id = changes.card_id AND changes.op != 'delete' "
+        "WHERE changes.seq > ? ORDER BY changes.seq LIMIT ?;"),
+    'fuzzy_delete_words': "DELETE FROM name_words WHERE card_id = ?;",
+    'fuzzy_set_key': "INSERT OR REPLACE INTO fuzzy_names (card_id, key, n) VALUES (?, ?, ?);",
+    'fuzzy_add_word': "INSERT OR IGNORE INTO fuzzy_words (word, n) VALUES (?, ?);",
+    'fuzzy_insert_word_tri': "INSERT INTO word_trigrams (tri, n, word, mask) VALUES (?, ?, ?, ?);",
+    'fuzzy_insert_name_word': "INSERT INTO name_words (word, n, card_id) VALUES (?, ?, ?);",
+    'fuzzy_word_df': "SELECT tri, n, df FROM word_trigram_df WHERE tri IN ({0});",
+    'fuzzy_words_by_tri': "SELECT word, mask FROM word_trigrams WHERE n = ? AND tri IN ({0});",
+    'fuzzy_word_cards': "SELECT word, cards FROM fuzzy_words WHERE word IN ({0}) AND cards > 0;",
+    # Не больше заданного числа карточек с любым из слов и с числом триграмм имени n в пределах
+    'fuzzy_cards_by_words': ("SELECT fuzzy_names.card_id, fuzzy_names.key, fuzzy_names.n FROM "
+        "(SELECT card_id FROM name_words WHERE word IN ({0}) AND n BETWEEN ? AND ? LIMIT ?) AS found "
+        "JOIN fuzzy_names ON fuzzy_names.card_id = found.card_id;"),
+    # Карточки одного частого слова: не больше заданного числа имён короче заданного n (от него вниз)
+    #    и не короче (вверх), то есть сначала самые близкие к нему по длине; {0} - условие на found
+    'fuzzy_cards_by_word': ("SELECT fuzzy_names.card_id, fuzzy_names.key, fuzzy_names.n FROM "
+        "(SELECT * FROM (SELECT card_id FROM name_words WHERE word = ? AND n BETWEEN ? AND ? ORDER BY n DESC LIMIT ?) "
+        "UNION ALL SELECT * FROM (SELECT card_id FROM name_words WHERE word = ? AND n BETWEEN ? AND ? ORDER BY n LIMIT ?)) "
+        "AS found JOIN fuzzy_names ON fuzzy_names.card_id = found.card_id{0};"),
+    # Условие для fuzzy_cards_by_word: в имени есть и одно из других слов
+    'fuzzy_with_words': (" WHERE EXISTS (SELECT 1 FROM name_words WHERE word IN ({0}) "
+        "AND name_words.card_id = found.card_id)"),
+    'cards_by_ids': "SELECT * FROM cards WHERE id IN ({0});",
+    'changes_last': "SELECT seq FROM sqlite_sequence WHERE name = 'changes';",
+    'changes_trim': "DELETE FROM changes WHERE seq <= ?;",
+    'changes_cards': "SELECT card_id FROM changes WHERE seq > ? AND seq <= ?;",
+    # Индексы и триггер FTS, отключённые на время загрузки new_cards(defer_indexes=True)
+    'deferred_find': ("SELECT type, name, sql FROM sqlite_master WHERE (type = 'index' AND tbl_name IN "
+        "('phones', 'cards') AND sql IS NOT NULL) OR (type = 'trigger' AND name = 'cards_fts_ai');"),
+    'deferred_add': "INSERT OR REPLACE INTO deferred_schema (type, name, sql) VALUES (?, ?, ?);",
+    'deferred_list': "SELECT type, name, sql FROM deferred_schema;",
+    'deferred_clear': "DELETE FROM deferred_schema;",
+    # Блоки возможных дублей: карточки с одинаковым номером телефона, почтой или набором слов имени
+    'dup_phones': ("SELECT group_concat(DISTINCT card_id) FROM phones GROUP BY digits "
+        "HAVING count(DISTINCT card_id) BETWEEN 2 AND ?;"),
+    'dup_mail': ("SELECT group_concat(id) FROM cards WHERE trim(mail) != '' GROUP BY lower(trim(mail)) "
+        "HAVING count(*) BETWEEN 2 AND ?;"),
+    'dup_names': ("SELECT group_concat(card_id) FROM fuzzy_names WHERE key != '' GROUP BY name_block(key) "
+        "HAVING count(*) BETWEEN 2 AND ?;"),
+    'dup_features': ("SELECT cards.id, lower(trim(cards.mail)), fuzzy_names.key, "
+        "(SELECT group_concat(digits) FROM phones WHERE phones.card_id = cards.id) FROM cards "
+        "LEFT JOIN fuzzy_names ON fuzzy_names.card_id = cards.id WHERE cards.id IN ({0});"),
+}
+
+
+@ft.lru_cache(maxsize=None)
+def sql_select(name: str, cols: tuple) -> str:
+    '''
+    Запрос SQL[name], выбирающий из cards только столбцы cols (кортеж, id - первым) вместо всех
+    '''
+    sql = SQL[name]
+    if cols==CARD_COLUMNS:
+        return sql
+    if 'cards.*' in sql:
+        return sql.replace('cards.*', ', '.join(['cards.'+i for i in cols]), 1)
+    return sql.replace('SELECT *', 'SELECT ' + ', '.join(cols), 1)
+
+
+@ft.lru_cache(maxsize=None)
+def sql_insert(cols: tuple) -> str:
+    '''
+    Запрос INSERT в cards для набора полей cols. Наборов полей конечное число, поэтому и разных
+    текстов запросов тоже - они строятся один раз и попадают в кэш соединения
+    '''
+    return "INSERT INTO cards ({0}) VALUES ({1});".format(', '.join(cols), ', '.join(['?']*len(cols)))
+
+
+@ft.lru_cache(maxsize=None)
+def sql_update(cols: tuple) -> str:
+    '''
+    Запрос UPDATE полей cols и даты изменения карточки по id
+    '''
+    return "UPDATE cards SET {0}, upd_dt = ? WHERE id = ?;".format(', '.join([i+' = ?' for i in cols]))
+
+
+def _vc_escape(value: str) -> str:
+    '''
+    Экранирование значения свойства vCard
+    '''
+    return (str(value).replace('\\', '\\\\').replace('\n', '\\n')
+        .replace(',', '\\,').replace(';', '\\;'))
+
+
+def _vc_unescape(value: str) -> str:
+    '''
+    Обратное к _vc_escape преобразование
+    '''
+    res, i = [], 0
+    while i<len(value):
+        if value[i]=='\\' and i+1<len(value):
+            i += 1
+            res.append('\n' if value[i] in 'nN' else value[i])
+        else:
+            res.append(value[i])
+        i += 1
+    return ''.join(res)
+
+
+def _vc_split(value: str) -> list:
+    '''
+    Делит составное значение vCard (N, ADR) на части по неэкранированным ';'
+    '''
+    res, cur, i = [], [], 0
+    while i<len(value):
+        if value[i]=='\\' and i+1<len(value):
+            cur.append(value[i:i+2])
+            i += 2
+            continue
+        if value[i]==';':
+            res.append(''.join(cur))
+            cur = []
+        else:
+            cur.append(value[i])
+        i += 1
+    return res + [''.join(cur)]
+
+
+def _vc_fold(line: str) -> str:
+    '''
+    Перенос длинной строки vCard: не более 75 символов в строке, продолжение начинается с пробела
+    '''
+    parts = [line[:75]] + [line[i:i+74] for i in range(75, len(line), 74)]
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def write_vcard(f, cards, version: str = '3.0') -> int:
+    '''
+    Пишет карточки из итерируемого cards в текстовый файл f в формате vCard 3.0 или 4.0.
+    Пары tlfN/commentN становятся свойствами TEL с подписью X-ABLabel из комментария.
+    Вернет количество записанных карточек
+    '''
+    tel = 'TEL;VALUE=text' if version=='4.0' else 'TEL'
+    count = 0
+    for crd in cards:
+        lines = ['BEGIN:VCARD', 'VERSION:{0}'.format(version),
+            'FN:{0}'.format(_vc_escape(crd['name'])), 'N:{0};;;;'.format(_vc_escape(crd['name']))]
+        for n in ['1', '2', '3']:
+            if crd['tlf'+n] not in ('', 'undefined'):
+                lines.append('item{0}.{1}:{2}'.format(n, tel, _vc_escape(crd['tlf'+n])))
+                if crd['comment'+n]!='':
+                    lines.append('item{0}.X-ABLabel:{1}'.format(n, _vc_escape(crd['comment'+n])))
+        for key, prop in [('adr', 'ADR:;;{0};;;;'), ('job', 'ORG:{0}'), ('mail', 'EMAIL:{0}'),
+                ('site', 'URL:{0}'), ('comment', 'NOTE:{0}')]:
+            if crd[key] not in ('', 'No comment'):
+                lines.append(prop.format(_vc_escape(crd[key])))
+        lines.append('END:VCARD')
+        f.write(''.join([_vc_fold(i) for i in lines]))
+        count += 1
+    return count
+
+
+def read_vcard(f):
+    '''
+    Генератор карточек (словарей в формате new_card) из текстового файла vCard 2.1/3.0/4.0.
+    Файл читается построчно. Первые три телефона попадают в tlf1..tlf3 (подпись X-ABLabel или
+    TYPE - в commentN), остальные дописываются в comment
+    '''
+    def props(lines):
+        # Склеиваем перенесённые строки и разбираем "группа.ИМЯ;параметры:значение"
+        cur = None
+        for line in lines:
+            line = line.rstrip('\r\n')
+            if line[:1] in (' ', '\t') and cur is not None:
+                cur += line[1:]
+                continue
+            if cur is not None:
+                yield cur
+            cur = line
+        if cur is not None:
+            yield cur
+
+    crd, labels, tels, extra = None, {}, [], []
+    for line in props(f):
+        head, _, value = line.partition(':')
+        name, *params = head.split(';')
+        group, _, name = name.rpartition('.')
+        name = name.upper()
+        if name=='BEGIN' and value.upper()=='VCARD':
+            crd, labels, tels, extra = {}, {}, [], []
+        elif crd is None:
+            continue
+        elif name=='END':
+            for n, (grp, number, tp) in enumerate(tels, 1):
+                label = labels.get(grp, tp) if grp else tp
+                if n<=3:
+                    crd['tlf{0}'.format(n)] = number
+                    if label:
+                        crd['comment{0}'.format(n)] = label
+                else:
+                    extra.append('{0} {1}'.format(number, label).strip())
+            if extra:
+                crd['comment'] = '; '.join(([crd['comment']] if 'comment' in crd else []) + extra)
+            if 'name' in crd:
+                yield crd
+            crd = None
+        elif name=='FN':
+            crd['name'] = _vc_unescape(value)
+        elif name=='N' and 'name' not in crd:
+            crd['name'] = ' '.join([_vc_unescape(i) for i in _vc_split(value) if i])
+        elif name=='TEL':
+            tp = ','.join([i.split('=', 1)[-1] for i in params if i.upper().startswith('TYPE=')]).strip('"')
+            number = value[4:] if value.lower().startswith('tel:') else value
+            tels.append((group, _vc_unescape(number), tp))
+        elif name=='X-ABLABEL':
+            labels[group] = _vc_unescape(value)
+        elif name=='ADR':
+            crd['adr'] = ', '.join([_vc_unescape(i) for i in _vc_split(value) if i])
+        else:
+            key = {'ORG': 'job', 'EMAIL': 'mail', 'URL': 'site', 'NOTE': 'comment'}.get(name)
+            if key and key not in crd:
+                crd[key] = _vc_unescape(value)
+
+
+def write_csv(f, cards) -> int:
+    '''
+    Пишет карточки в CSV-файл f со строкой заголовков. Вернет количество записанных карточек
+    '''
+    import csv
+    wr = csv.DictWriter(f, fieldnames=CARD_KEYS, extrasaction='ignore')
+    wr.writeheader()
+    count = 0
+    for crd in cards:
+        wr.writerow(crd)
+        count += 1
+    return count
+
+
+def read_csv(f):
+    '''
+    Генератор карточек из CSV-файла f. Первая строка - имена полей
+    '''
+    import csv
+    for row in csv.DictReader(f):
+        yield {k: v for k, v in row.items() if k is not None and v is not None}
+
+
+def write_jsonl(f, cards) -> int:
+    '''
+    Пишет карточки в файл f по одному JSON-объекту в строке. Вернет количество записанных карточек
+    '''
+    import json
+    count = 0
+    for crd in cards:
+        f.write(json.dumps(dict(crd), ensure_ascii=False) + '\n')
+        count += 1
+    return count
+
+
+def read_jsonl(f):
+    '''
+    Генератор карточек из файла f с JSON-объектом в каждой строке. Пустые строки пропускаются
+    '''
+    import json
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+
+# Форматы файлов обмена: расширение -> (чтение, запись)
+FILE_FORMATS = {
+    'csv': (read_csv, write_csv),
+    'jsonl': (read_jsonl, write_jsonl),
+    'vcf': (read_vcard, write_vcard),
+}
+
+
+class Card(collections.abc.Mapping):
+    '''
+    Карточка контакта - компактная неизменяемая запись. Хранит строку из БД как есть (кортеж
+    значений) и ссылку на общую для всех карточек с тем же набором столбцов таблицу "поле -> номер",
+    поэтому, в отличие от словаря, не держит на каждую строку свою хеш-таблицу ключей.
+    Читается как словарь: crd['name'], crd.get('mail'), 'tlf1' in crd, keys(), values(), items(),
+    len(crd), сравнение со словарём. Изменяемая копия - dict(crd)
+    '''
+    __slots__ = ('_index', '_values')
+
+    # Таблицы "поле -> номер" для каждого набора столбцов
+    _layouts = {}
+
+    def __init__(self, values, columns=CARD_COLUMNS):
+        self._index = self.layout(tuple(columns))
+        self._values = tuple(values)
+
+    @classmethod
+    def layout(cls, columns: tuple) -> dict:
+        index = cls._layouts.get(columns)
+        if index is None:
+            index = cls._layouts.setdefault(columns, {k: i for i, k in enumerate(columns)})
+        return index
+
+    @classmethod
+    def from_rows(cls, rows, columns: tuple = CARD_COLUMNS) -> list:
+        '''
+        Список карточек из строк выборки rows со столбцами columns (без копирования строк)
+        '''
+        index, new, res = cls.layout(columns), cls.__new__, []
+        for row in rows:
+            crd = new(cls)
+            crd._index, crd._values = index, row
+            res.append(crd)
+        return res
+
+    def __getitem__(self, key):
+        return self._values[self._index[key]]
+
+    def get(self, key, default=None):
+        i = self._index.get(key)
+        return default if i is None else self._values[i]
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __repr__(self):
+        return 'Card({0!r})'.format(dict(self))
+
+    def __reduce__(self):
+        return (Card, (self._values, tuple(self._index)))
+
+
+class LRUCache():
+    '''
+    Ограниченный по размеру потокобезопасный кэш с вытеснением давно не использованных записей
+    obj.get(key) - значение или None, если записи нет или истёк её срок жизни ttl (в секундах)
+    obj.put(key, value, generation) - сохранить значение, прочитанное при поколении generation
+    obj.invalidate(key=None) - удалить запись (без key - очистить весь кэш)
+    obj.stats() -> dict - счётчики попаданий, промахов, вытеснений и сбросов
+    '''
+
+    def __init__(self, maxsize: int, ttl: float = None):
+        self.maxsize, self.ttl = maxsize, ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # Поколение увеличивается при каждом сбросе. Значение, прочитанное из БД до сброса, в кэш
+        #    уже не попадёт - иначе медленный читатель мог бы вернуть в кэш устаревшую карточку
+        self.generation = 0
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or (self.ttl is not None and item[1]<time.monotonic()):
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, generation: int):
+        with self._lock:
+            if generation!=self.generation:
+                return
+            self._data[key] = (value, None if self.ttl is None else time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data)>self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        with self._lock:
+            self.generation += 1
+            self.invalidations += 1
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'invalidations': self.invalidations}
+
+
+class QueryStats():
+    '''
+    Замеры CardList, включаемые параметром instrument: время каждого запроса SQL (выполнение и
+    чтение результата), количество вызовов и гистограмма задержек каждого метода, журнал медленных
+    запросов с их планом (EXPLAIN QUERY PLAN). Медленные запросы пишутся в журнал logging 'telfbook'
+    с уровнем WARNING. callback(event: dict) вызывается после каждого замеренного метода
+    ({'type': 'op', 'name', 'seconds'}) и для каждого медленного запроса ({'type': 'slow_query',
+    'sql', 'params', 'seconds', 'op', 'plan'}) - через него замеры можно выгружать в свою систему метрик
+    obj.snapshot(reset: bool = False) -> dict - текущие значения счётчиков
+    '''
+
+    # Верхние границы корзин гистограммы задержек, в секундах
+    buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, math.inf)
+    # Сколько последних медленных запросов хранить для snapshot()
+    slow_keep = 100
+
+    def __init__(self, slow_query: float = 0.1, callback=None):
+        self.slow_query, self.callback = slow_query, callback
+        self._lock = threading.Lock()
+        # Метод, выполняемый в текущем потоке, - к нему относятся запросы SQL
+        self._local = threading.local()
+        self._reset()
+
+    def _reset(self):
+        # {метод: [вызовов, суммарное время, наибольшее время, [вызовов в каждой корзине]]}
+        self.ops = {}
+        # {текст запроса: [выполнений, суммарное время, наибольшее время одного выполнения]}
+        self.queries = {}
+        self.slow = collections.deque(maxlen=self.slow_keep)
+
+    def wrap(self, name: str, fn):
+        '''
+        Вернёт fn, обёрнутую замером времени. Запросы SQL, выполненные внутри, относятся к самому
+        внешнему из замеряемых методов
+        '''
+        local = self._local
+
+        @ft.wraps(fn)
+        def method(*args, **kwargs):
+            outer = getattr(local, 'op', None)
+            if outer is None:
+                local.op = name
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - t0
+                if outer is None:
+                    local.op = None
+                self.record_op(name, elapsed)
+        return method
+
+    def record_op(self, name: str, elapsed: float):
+        with self._lock:
+            item = self.ops.get(name)
+            if item is None:
+                item = self.ops[name] = [0, 0.0, 0.0, [0] * len(self.buckets)]
+            item[0] += 1
+            item[1] += elapsed
+            item[2] = max(item[2], elapsed)
+            item[3][bisect.bisect_left(self.buckets, elapsed)] += 1
+        if self.callback is not None:
+            self.callback({'type': 'op', 'name': name, 'seconds': elapsed})
+
+    def record_query(self, curs: sq3.Cursor, sql: str, params, elapsed: float):
+        '''
+        Учитывает время выполнения запроса (sql задан) или чтения очередной части его результата
+        (sql=None) курсором curs. Запрос попадает в журнал медленных, как только его общее время
+        превысит slow_query
+        '''
+        if sql is not None:
+            curs._query = [sql, params, 0.0, False]
+        query = getattr(curs, '_query', None)
+        if query is None:
+            return
+        query[2] += elapsed
+        with self._lock:
+            item = self.queries.get(query[0])
+            if item is None:
+                item = self.queries[query[0]] = [0, 0.0, 0.0]
+            item[0] += sql is not None
+            item[1] += elapsed
+            item[2] = max(item[2], query[2])
+        if query[3] or self.slow_query is None or query[2]<self.slow_query:
+            return
+        query[3] = True
+        event = {'type': 'slow_query', 'sql': query[0], 'params': query[1], 'seconds': query[2],
+            'op': getattr(self._local, 'op', None), 'plan': self.explain(curs.connection, query[0], query[1])}
+        with self._lock:
+            self.slow.append(event)
+        import logging
+        logging.getLogger(__name__).warning('slow query %.3f s in %s: %s %s', query[2], event['op'], query[0], ' | '.join(event['plan']))
+        if self.callback is not None:
+            self.callback(event)
+
+    @staticmethod
+    def explain(conn: sq3.Connection, sql: str, params) -> list:
+        '''
+        План выполнения запроса (строки EXPLAIN QUERY PLAN). Для executemany параметры неизвестны,
+        поэтому подставляются NULL - на выбор индексов это не влияет
+        '''
+        if params is None:
+            params = (None,) * sql.count('?')
+        try:
+            # Обычный курсор, чтобы сам EXPLAIN не попал в замеры
+            return [i[-1] for i in sq3.Cursor(conn).execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+        except sq3.Error:
+            return []
+
+    def snapshot(self, reset: bool = False) -> dict:
+        with self._lock:
+            bounds = ['<={0:g}ms'.format(i * 1000) if i!=math.inf else 'inf' for i in self.buckets]
+            res = {
+                'ops': {name: {'count': n, 'total': total, 'max': top, 'avg': total / n,
+                    'histogram': dict(zip(bounds, hist))} for name, (n, total, top, hist) in self.ops.items()},
+                'queries': {sql: {'count': n, 'total': total, 'max': top}
+                    for sql, (n, total, top) in self.queries.items()},
+                'slow_queries': list(self.slow),
+            }
+            if reset:
+                self._reset()
+        return res
+
+
+class _TracedCursor(sq3.Cursor):
+    '''
+    Курсор, замеряющий время выполнения запросов и чтения результата (для QueryStats)
+    '''
+
+    def execute(self, sql, parameters=()):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.stats.record_query(self, sql, parameters, time.perf_counter() - t0)
+
+    def executemany(self, sql, seq_of_parameters):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.connection.stats.record_query(self, sql, None, time.perf_counter() - t0)
+
+    def fetchone(self):
+        t0 = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self.connection.stats.record_query(self, None, None, time.perf_counter() - t0)
+
+    def fetchmany(self, *args):
+        t0 = time.perf_counter()
+        try:
+            return super().fetchmany(*args)
+        finally:
+            self.connection.stats.record_query(self, None, None, time.perf_counter() - t0)
+
+    def fetchall(self):
+        t0 = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self.connection.stats.record_query(self, None, None, time.perf_counter() - t0)
+
+
+class _TracedConnection(sq3.Connection):
+    '''
+    Соединение, все курсоры которого - _TracedCursor. Используется только при включённых замерах,
+    без них CardList открывает обычные соединения и не тратит время на учёт
+    '''
+    stats = None
+
+    def cursor(self, factory=_TracedCursor):
+        return super().cursor(factory)
+
+    # Connection.execute создаёт курсор в обход cursor(), поэтому переопределяются и они
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
 class CardList():
     '''
     Объектом класса является база данных контактов
     obj.dbfile - текущее имя файла базы данных
     obj.new_card(crd: dict) - создание новой карточки контакта
+    obj.new_cards(cards, batch_size: int = 1000) -> tuple - массовое добавление карточек
     obj.row_count() -> int - общее количество строк в БД
-    obj.avail_id() -> list - список доступных id карточек
+    obj.avail_id(limit: int = None) -> list - список доступных id карточек
+    obj.has_card(card_id: int) -> bool - есть ли карточка с таким id
     obj.delete_card(card_id: int) - удаление строки по известному id
-    obj.get_card(card_id: int) -> dict - вернёт запись по известному id
+    obj.get_card(card_id: int) -> Card - вернёт запись по известному id
     obj.update_card(card_id: int, column_to_update: str, new_value: str) - изменить ячейку
-    obj.search(pattern: str) -> list - вернет список карточек, в полях которых встречается шаблон pattern
+    obj.update_fields(card_id: int, fields: dict) -> int - изменить несколько полей одним запросом
+    obj.update_cards(changes) -> int - массовое изменение карточек
+    obj.search(pattern: str, mode: str = 'like') -> list - вернет список карточек, в полях которых
+        встречается шаблон pattern; mode='fts' - ранжированный поиск по полнотекстовому индексу
     obj.any_req(db_request: str) -> list - произвольный запрос к базе данных
+    obj.search_fuzzy(query: str, threshold: float = 0.45) -> list - нечёткий поиск по имени
+    obj.search_page(pattern: str, after=None, page_size: int = 50) -> tuple - страница результатов поиска
+    obj.iter_search(pattern: str) - ленивый генератор результатов поиска, читаемых страницами
+    obj.find_by_phone(number: str, suffix: int = None) -> list - поиск карточек по номеру телефона
+    obj.iter_cards(chunk_size: int = 1000) - генератор всех карточек, читаемых порциями
+    obj.export_file(filename: str) -> tuple - выгрузка карточек в файл csv, jsonl или vcf
+    obj.import_file(filename: str) -> tuple - загрузка карточек из файла csv, jsonl или vcf
+    obj.changes_since(seq: int) - генератор изменений карточек после изменения с номером seq
+    obj.last_change() -> int - номер последнего изменения
+    obj.trim_changes(seq: int) -> int - удалить из журнала изменения до seq включительно
+    obj.find_duplicates(threshold: float = 0.7) - генератор групп вероятных дублей
+    obj.merge_cards(ids: list) -> int - слить несколько карточек в одну
+    obj.backup(dest, pages_per_step: int = 1024) -> tuple - горячая копия БД в файл dest
+    obj.compact(pages_per_step: int = 256) -> tuple - вернуть файлу место, освободившееся после удалений
+    obj.refresh_replica(force: bool = True) -> bool - перечитать копию БД в памяти (режим replica)
+    obj.cache_stats() -> dict - счётчики кэша карточек (если он включён параметром cache_size)
+    obj.stats(reset: bool = False) -> dict - замеры методов и запросов (если включены параметром instrument)
+    obj.close() - закрыть все открытые соединения с БД
+
+    С параметром replica файл БД при открытии копируется в память, и get_card, search, search_page,
+    search_fuzzy, find_by_phone и другие методы чтения обращаются к копии, а не к диску. Запись идёт
+    в файл, копия перечитывается при его изменении (см. refresh_replica). Для служб, которые почти
+    только читают редко меняющийся справочник
+
+    Методы чтения возвращают карточки как Card - неизменяемые записи, доступные как словарь. Им
+    можно передать columns - список нужных полей: тогда из БД читаются только они (и всегда id).
+
+    Соединение с БД открывается одно на поток и переиспользуется всеми методами. Объект можно
+    использовать как контекстный менеджер: with CardList('tlfbook.tdb') as db: ...
+
+    С одним файлом БД могут одновременно работать несколько процессов. В режиме WAL читатели не
+    ждут писателей. Каждая запись - транзакция BEGIN IMMEDIATE: блокировка записи берётся в самом
+    начале, поэтому транзакции не упираются друг в друга посередине. Занятую блокировку соединение
+    ждёт до busy_timeout секунд, затем повторяет попытку до write_retries раз со случайной паузой.
+    Записи из разных процессов выполняются по очереди, поэтому общая скорость почти не зависит от
+    числа процессов: при 1-8 процессах - около 1700-2400 операций new_card/update_card в секунду
+    (замер python bench_telfbook.py writers)
     '''
+
+    # Параметры, выставляемые каждому новому соединению
+    pragmas = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -8000, # 8 Мб
+        'mmap_size': 67108864, # 64 Мб
+    }
+
+    # Текстовые поля карточки, попадающие в полнотекстовый индекс
+    fts_columns = FTS_COLUMNS
+
+    # Размер кэша разобранных запросов соединения (по умолчанию в sqlite3 - 128)
+    cached_statements = 256
+
+    # Пределы просмотра в search_fuzzy: строк словаря на каждое слово запроса и карточек на весь
+    #    запрос. От них, а не от размера справочника, зависит время нечёткого поиска
+    fuzzy_word_scan = 600
+    fuzzy_card_scan = 1000
+
+    # Веса признаков при оценке пары карточек как дублей: похожесть имён (0..1), общий номер
+    #    телефона, одинаковая почта. Сумма, ограниченная единицей, сравнивается с порогом
+    dup_weights = {'name': 0.5, 'phone': 0.35, 'mail': 0.25}
+
+    # Повторы начала пишущей транзакции, если блокировка не освободилась за busy_timeout, и
+    #    наибольшая пауза перед первым повтором в секундах (дальше удваивается)
+    write_retries = 5
+    retry_delay = 0.05
+
+    # Методы, время которых замеряется при instrument=True. Генераторы (iter_search и т.п.) не
+    #    замеряются сами, но учитываются вызываемые ими search_page и запросы
+    instrumented_methods = {'new_card', 'new_cards', 'row_count', 'avail_id', 'has_card', 'delete_card',
+        'get_card', 'update_card', 'update_fields', 'update_cards', 'search', 'search_fuzzy', 'search_page',
+        'find_by_phone', 'export_file', 'import_file', 'last_change', 'trim_changes', 'merge_cards', 'backup',
+        'compact', 'refresh_replica', 'any_req'}
     
-    def __init__(self, dbfilename: str):
+    def __init__(self, dbfilename: str, pragmas: dict = None, cache_size: int = 0, cache_ttl: float = None,
+            instrument: bool = False, slow_query: float = 0.1, on_metric=None, busy_timeout: float = 5.0,
+            lazy: bool = False, replica: float = None):
+        '''
+        В начале, просто проверяем существование файла базы данных, создаём его если не существует
+        pragmas - словарь PRAGMA, дополняющий или заменяющий значения по умолчанию
+        cache_size - размер кэша карточек для get_card (0 - без кэша), cache_ttl - срок жизни
+        записи кэша в секундах (None - без ограничения)
+        instrument - включить замеры (см. QueryStats): slow_query - порог медленного запроса в
+        секундах (None - не вести журнал), on_metric(event: dict) - функция выгрузки замеров.
+        Без instrument методы и соединения остаются обычными и замеры ничего не стоят
+        busy_timeout - сколько секунд ждать блокировку, занятую другим соединением или процессом
+        lazy - ничего не делать с файлом в конструкторе: он открывается, а схема проверяется при первом
+        обращении. Для коротких программ, которым нужно одно-два чтения
+        replica - читать из копии БД в памяти (см. refresh_replica), проверяя изменения файла каждые
+        replica секунд (0 - копия обновляется только вызовом refresh_replica). None - читать из файла
+        '''
+        # Имя файла базы данных
+        self.dbfile = dbfilename
+
+        self.pragmas = dict(self.pragmas, **(pragmas or {}))
+        self.busy_timeout = busy_timeout
+        # Соединения хранятся отдельно для каждого потока; список нужен, чтобы закрыть их все в close()
+        self._local = threading.local()
+        self._conns = []
+        self._conns_lock = threading.Lock()
+
+        # Файлы БД, для которых уже проверена схема, и признак наличия в них индекса FTS5
+        self._schema_ready = {}
+        self._schema_lock = threading.Lock()
+
+        self._cache = LRUCache(cache_size, cache_ttl) if cache_size>0 else None
+        # Номер последней записи журнала changes каждого файла, изменения до которой уже убраны из кэша
+        self._cache_seq = {}
+        self._cache_seq_lock = threading.Lock()
+
+        # Копия БД в памяти: кортеж (файл, имя копии, соединение, держащее копию, соединение с файлом
+        #    для проверки изменений, data_version файла при загрузке копии) и поток, следящий за файлом
+        self.replica = replica
+        self._replica = None
+        self._replica_gen = 0
+        self._replica_lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._replica_thread = None
+        self._replica_stop = threading.Event()
+
+        # Замеры: методы объекта подменяются обёртками с учётом времени
+        self._stats = None
+        if instrument:
+            self._stats = QueryStats(slow_query, on_metric)
+            for name in self.instrumented_methods:
+                setattr(self, name, self._stats.wrap(name, getattr(self, name)))
+
+        if not lazy:
+            self._connect()
+            if replica is not None:
+                self.refresh_replica()
+
+    def _init_schema(self, conn: sq3.Connection):
+        '''
+        Приводит схему файла БД к текущей версии: по очереди выполняет миграции, номер которых
+        больше записанного в файле PRAGMA user_version. Каждая миграция - отдельная транзакция,
+        вместе с ней записывается и новый номер версии. Затем подключает полнотекстовый индекс
+        '''
+        version = conn.execute("PRAGMA user_version;").fetchone()[0]
+        for num, step in enumerate(self.migrations, 1):
+            if num<=version:
+                continue
+            self._begin(conn)
+            try:
+                # Файл мог обновить другой процесс, пока мы ждали блокировку
+                if conn.execute("PRAGMA user_version;").fetchone()[0]<num:
+                    step(self, conn.cursor())
+                    conn.execute("PRAGMA user_version = {0};".format(num))
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+        self._schema_ready[self.dbfile] = self._init_fts(conn)
+        # Загрузка с отложенными индексами не закончилась (процесс завершился посередине) или идёт
+        #    сейчас в другом процессе - восстановить их безопасно в обоих случаях
+        if conn.execute(SQL['deferred_list']).fetchone() is not None:
+            self._restore_deferred(conn)
+
+    def _mig_cards(self, curs: sq3.Cursor):
+        '''
+        Миграция 1: таблица карточек
+        '''
+        rownames = [
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, ", # ID карточки
+            "name TEXT NOT NULL, ", # ФИО
+            "tlf1 TEXT DEFAULT 'undefined', ", # Первый телефон
+            "comment1 TEXT DEFAULT '', ", # Комментарий к первому телефону
+            "tlf2 TEXT DEFAULT '', ", # Второй телефон
+            "comment2 TEXT DEFAULT '', ", # Комментарий ко второму телефону
+            "tlf3 TEXT DEFAULT '', ", # Третий телефон
+            "comment3 TEXT DEFAULT '', ", # Комментарий к третьему телефону
+            "adr TEXT DEFAULT '', ", # Адрес
+            "job TEXT DEFAULT '', ", # Место работы
+            "mail TEXT DEFAULT '', ", # Электронная почта
+            "site TEXT DEFAULT '', ", # Сайт
+            "comment TEXT DEFAULT 'No comment', ", # Комментарий
+            "cr_dt TEXT, ", # Дата создания карточки
+            "upd_dt TEXT" # Дата последнего изменения
+        ]
+        rqtosq3 = "CREATE TABLE IF NOT EXISTS cards ({0});".format(''.join(rownames))
+        curs.execute(rqtosq3)
+
+    def _mig_phones(self, curs: sq3.Cursor):
+        '''
+        Миграция 2: таблица нормализованных номеров phones (по строке на каждый непустой tlf1..tlf3)
+        с индексами для точного поиска и поиска по последним цифрам (по перевёрнутой строке).
+        Для уже существующих файлов БД таблица заполняется по текущему содержимому cards
+        '''
+        curs.execute("SELECT 1 FROM sqlite_master WHERE name = 'phones';")
+        if curs.fetchone() is not None:
+            return
+
+        curs.execute(
+            "CREATE TABLE phones (card_id INTEGER NOT NULL, slot INTEGER NOT NULL, "
+            "digits TEXT NOT NULL, rdigits TEXT NOT NULL, PRIMARY KEY (card_id, slot));"
+        )
+        curs.execute("CREATE INDEX phones_digits ON phones (digits);")
+        curs.execute("CREATE INDEX phones_rdigits ON phones (rdigits);")
+        # Удаление карточки любым способом удаляет и её номера
+        curs.execute(
+            "CREATE TRIGGER phones_ad AFTER DELETE ON cards BEGIN "
+            "DELETE FROM phones WHERE card_id = old.id; END;"
+        )
+        rows = curs.connection.execute("SELECT id, tlf1, tlf2, tlf3 FROM cards;")
+        for card_id, *tlfs in rows:
+            self._index_phones(curs, card_id, dict(zip(['tlf1', 'tlf2', 'tlf3'], tlfs)))
+
+    def _mig_indexes(self, curs: sq3.Cursor):
+        '''
+        Миграция 3: индексы для отбора и сортировки по имени (без учёта регистра латиницы), месту
+        работы, почте и дате изменения
+        '''
+        curs.execute("CREATE INDEX IF NOT EXISTS cards_name ON cards (name COLLATE NOCASE);")
+        curs.execute("CREATE INDEX IF NOT EXISTS cards_job ON cards (job);")
+        curs.execute("CREATE INDEX IF NOT EXISTS cards_mail ON cards (mail);")
+        curs.execute("CREATE INDEX IF NOT EXISTS cards_upd_dt ON cards (upd_dt);")
+
+    def _mig_timestamps(self, curs: sq3.Cursor):
+        '''
+        Миграция 4: даты cr_dt и upd_dt, записанные в другом понятном sqlite формате (например,
+        ISO 8601 с "T" или с долями секунды), приводятся к единому виду "ГГГГ-ММ-ДД чч:мм:сс"
+        '''
+        for col in ['cr_dt', 'upd_dt']:
+            curs.execute(
+                "UPDATE cards SET {0} = datetime({0}) WHERE datetime({0}) IS NOT NULL AND {0} != datetime({0});".format(col)
+            )
+
+    def _mig_changes(self, curs: sq3.Cursor):
+        '''
+        Миграция 5: журнал изменений карточек. Триггеры записывают в changes каждое добавление,
+        изменение и удаление карточки (любым способом, в т.ч. через any_req) с возрастающим номером seq
+        '''
+        curs.execute(
+            "CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "card_id INTEGER NOT NULL, op TEXT NOT NULL, ts TEXT NOT NULL);"
+        )
+        for op, event, ref in [('insert', 'INSERT', 'new'), ('update', 'UPDATE', 'new'), ('delete', 'DELETE', 'old')]:
+            curs.execute(
+                "CREATE TRIGGER IF NOT EXISTS changes_{0} AFTER {1} ON cards BEGIN "
+                "INSERT INTO changes (card_id, op, ts) VALUES ({2}.id, '{0}', "
+                "strftime('%Y-%m-%d %H:%M:%S', 'now', 'localtime')); END;".format(op, event, ref)
+            )
+
+    def _mig_fuzzy(self, curs: sq3.Cursor):
+        '''
+        Миграция 6: индекс имён для нечёткого поиска - словарь слов имён (слов в справочнике в
+        десятки раз меньше, чем карточек). fuzzy_names - приведённое имя каждой карточки и число
+        его триграмм n, fuzzy_words - слова имён с числом триграмм n и числом карточек cards,
+        word_trigrams - триграммы слов с длиной слова и маской всех его триграмм (см. trigram_mask),
+        word_trigram_df - количество слов с каждой триграммой и длиной, name_words - слова имени
+        каждой карточки вместе с n имени (карточки слова читаются сразу в пределах длины имени). Слова из словаря не удаляются: слово без карточек (cards = 0) поиск
+        пропускает. Для уже существующих файлов БД индекс строится по текущему содержимому cards
+        '''
+        curs.execute(
+            "CREATE TABLE IF NOT EXISTS fuzzy_names (card_id INTEGER PRIMARY KEY, key TEXT NOT NULL, "
+            "n INTEGER NOT NULL);"
+        )
+        curs.execute(
+            "CREATE TABLE IF NOT EXISTS fuzzy_words (word TEXT PRIMARY KEY, n INTEGER NOT NULL, "
+            "cards INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID;"
+        )
+        curs.execute(
+            "CREATE TABLE IF NOT EXISTS word_trigrams (tri TEXT NOT NULL, n INTEGER NOT NULL, word TEXT NOT NULL, "
+            "mask INTEGER NOT NULL, PRIMARY KEY (tri, n, word)) WITHOUT ROWID;"
+        )
+        curs.execute(
+            "CREATE TABLE IF NOT EXISTS word_trigram_df (tri TEXT NOT NULL, n INTEGER NOT NULL, df INTEGER NOT NULL, "
+            "PRIMARY KEY (tri, n)) WITHOUT ROWID;"
+        )
+        curs.execute(
+            "CREATE TABLE IF NOT EXISTS name_words (word TEXT NOT NULL, n INTEGER NOT NULL, "
+            "card_id INTEGER NOT NULL, PRIMARY KEY (word, n, card_id)) WITHOUT ROWID;"
+        )
+        curs.execute("CREATE INDEX IF NOT EXISTS name_words_card ON name_words (card_id);")
+        curs.execute(
+            "CREATE TRIGGER IF NOT EXISTS word_trigram_df_ai AFTER INSERT ON word_trigrams BEGIN "
+            "INSERT INTO word_trigram_df (tri, n, df) VALUES (new.tri, new.n, 1) "
+            "ON CONFLICT (tri, n) DO UPDATE SET df = df + 1; END;"
+        )
+        curs.execute(
+            "CREATE TRIGGER IF NOT EXISTS name_words_ai AFTER INSERT ON name_words BEGIN "
+            "UPDATE fuzzy_words SET cards = cards + 1 WHERE word = new.word; END;"
+        )
+        curs.execute(
+            "CREATE TRIGGER IF NOT EXISTS name_words_ad AFTER DELETE ON name_words BEGIN "
+            "UPDATE fuzzy_words SET cards = cards - 1 WHERE word = old.word; END;"
+        )
+        curs.execute(
+            "CREATE TRIGGER IF NOT EXISTS fuzzy_ad AFTER DELETE ON cards BEGIN "
+            "DELETE FROM name_words WHERE card_id = old.id; DELETE FROM fuzzy_names WHERE card_id = old.id; END;"
+        )
+        rows = curs.connection.execute("SELECT id, name FROM cards;")
+        while True:
+            batch = rows.fetchmany(10000)
+            if not batch:
+                break
+            self._index_keys(curs, [(card_id, fuzzy_key(name)) for card_id, name in batch])
+
+    def _mig_deferred(self, curs: sq3.Cursor):
+        '''
+        Миграция 7: deferred_schema - определения индексов и триггера FTS, удалённых на время загрузки
+        с defer_indexes=True. Записываются в одной транзакции с удалением, поэтому после сбоя
+        посреди загрузки _init_schema знает, что восстановить
+        '''
+        curs.execute(
+            "CREATE TABLE IF NOT EXISTS deferred_schema (name TEXT PRIMARY KEY, type TEXT NOT NULL, sql TEXT NOT NULL);"
+        )
+
+    # Миграции схемы по порядку: номер миграции - её позиция в списке, начиная с 1
+    migrations = [_mig_cards, _mig_phones, _mig_indexes, _mig_timestamps, _mig_changes, _mig_fuzzy, _mig_deferred]
+
+    def _init_fts(self, conn: sq3.Connection) -> bool:
+        '''
+        Создаёт полнотекстовый индекс cards_fts (FTS5) и триггеры, поддерживающие его в актуальном
+        состоянии. Для уже существующих файлов БД индекс заполняется по текущему содержимому cards.
+        Вернет False, если sqlite3 собран без FTS5 - тогда поиск работает только через LIKE
+        '''
+        curs = conn.cursor()
+        curs.execute("SELECT 1 FROM sqlite_master WHERE name = 'cards_fts';")
+        if curs.fetchone() is not None:
+            return True
+
+        cols = ', '.join(self.fts_columns)
+        new_cols = ', '.join(['new.'+i for i in self.fts_columns])
+        old_cols = ', '.join(['old.'+i for i in self.fts_columns])
+        rqfts = [
+            # unicode61 приводит к одному регистру и кириллицу, prefix ускоряет поиск по началу слова
+            "CREATE VIRTUAL TABLE cards_fts USING fts5({0}, content='cards', content_rowid='id', "
+                "tokenize='unicode61 remove_diacritics 2', prefix='2 3');".format(cols),
+            "CREATE TRIGGER cards_fts_ai AFTER INSERT ON cards BEGIN "
+                "INSERT INTO cards_fts(rowid, {0}) VALUES (new.id, {1}); END;".format(cols, new_cols),
+            "CREATE TRIGGER cards_fts_ad AFTER DELETE ON cards BEGIN "
+                "INSERT INTO cards_fts(cards_fts, rowid, {0}) VALUES ('delete', old.id, {1}); END;".format(cols, old_cols),
+            "CREATE TRIGGER cards_fts_au AFTER UPDATE ON cards BEGIN "
+                "INSERT INTO cards_fts(cards_fts, rowid, {0}) VALUES ('delete', old.id, {1}); "
+                "INSERT INTO cards_fts(rowid, {0}) VALUES (new.id, {2}); END;".format(cols, old_cols, new_cols),
+            # Заполняем индекс уже имеющимися карточками
+            "INSERT INTO cards_fts(cards_fts) VALUES ('rebuild');",
+        ]
+        self._begin(conn)
+        try:
+            with conn:
+                # Индекс мог создать другой процесс, пока мы ждали блокировку
+                curs.execute("SELECT 1 FROM sqlite_master WHERE name = 'cards_fts';")
+                if curs.fetchone() is None:
+                    for rq in rqfts:
+                        curs.execute(rq)
+        except sq3.OperationalError:
+            return False
+        return True
+
+    def _index_name(self, curs: sq3.Cursor, card_id: int, name: str):
+        '''
+        Обновляет индекс нечёткого поиска для имени карточки card_id. Выполняется в транзакции
+        вызывающего метода
+        '''
+        curs.execute(SQL['fuzzy_delete_words'], (card_id,))
+        self._index_keys(curs, [(card_id, fuzzy_key(name))])
+
+    def _index_keys(self, curs: sq3.Cursor, keys: list):
+        '''
+        Добавляет в индекс нечёткого поиска приведённые имена карточек [(card_id, key), ...]: новые
+        слова - в словарь вместе с их триграммами, слова каждого имени - в name_words. Выполняется
+        в транзакции вызывающего метода
+        '''
+        keys = [(card_id, key, len(trigrams(key))) for card_id, key in keys]
+        curs.executemany(SQL['fuzzy_set_key'], keys)
+        words = {word for _, key, _ in keys for word in key.split()}
+        for word in words:
+            tris = trigrams(word)
+            curs.execute(SQL['fuzzy_add_word'], (word, len(tris)))
+            # Слово уже было в словаре - его триграммы тоже
+            if curs.rowcount==1:
+                mask = trigram_mask(tris)
+                curs.executemany(SQL['fuzzy_insert_word_tri'], [(i, len(tris), word, mask) for i in tris])
+        curs.executemany(SQL['fuzzy_insert_name_word'], [(word, n, card_id) for card_id, key, n in keys for word in set(key.split())])
+
+    def _index_phones(self, curs: sq3.Cursor, card_id: int, crd: dict):
+        '''
+        Обновляет в phones номера карточки card_id для тех полей tlf1..tlf3, которые есть в crd.
+        Выполняется в транзакции вызывающего метода
+        '''
+        for slot, key in enumerate(['tlf1', 'tlf2', 'tlf3'], 1):
+            if key not in crd:
+                continue
+            curs.execute(SQL['phones_delete'], (card_id, slot))
+            digits = normalize_phone(crd[key])
+            if digits:
+                curs.execute(SQL['phones_insert'], (card_id, slot, digits, digits[::-1]))
+
+    def _connect(self) -> sq3.Connection:
+        '''
+        Вернёт соединение с БД для текущего потока. Соединение открывается при первом обращении и
+        дальше переиспользуется. Если obj.dbfile сменили, старое соединение закрывается и
+        открывается новое
+        '''
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            if self._local.dbfile == self.dbfile:
+                return conn
+            self._release(conn)
+
+        if self._stats is None:
+            conn = sq3.connect(self.dbfile, timeout=self.busy_timeout, check_same_thread=False,
+                cached_statements=self.cached_statements)
+        else:
+            conn = sq3.connect(self.dbfile, timeout=self.busy_timeout, check_same_thread=False,
+                cached_statements=self.cached_statements, factory=_TracedConnection)
+            conn.stats = self._stats
+        # Режим auto_vacuum для compact() задаётся только новому, ещё пустому файлу: на существующем
+        #    файле эта PRAGMA требует блокировки записи, и читатель ждал бы писателей. Старые файлы
+        #    переводятся в этот режим при первом вызове compact()
+        if conn.execute("PRAGMA page_count;").fetchone()[0]==0:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        for name, value in self.pragmas.items():
+            conn.execute('PRAGMA {0}={1};'.format(name, value))
+        self._local.conn, self._local.dbfile = conn, self.dbfile
+        self._local.data_version = None
+        with self._conns_lock:
+            self._conns.append(conn)
+        if self.dbfile not in self._schema_ready:
+            with self._schema_lock:
+                if self.dbfile not in self._schema_ready:
+                    self._init_schema(conn)
+        return conn
+
+    def _begin(self, conn: sq3.Connection):
+        '''
+        Начинает пишущую транзакцию (BEGIN IMMEDIATE). Если блокировку записи держит другое
+        соединение дольше busy_timeout, попытка повторяется до write_retries раз после случайной
+        паузы, растущей вдвое с каждым повтором - так процессы, упёршиеся в блокировку одновременно,
+        расходятся по времени
+        '''
+        for attempt in range(self.write_retries + 1):
+            try:
+                conn.execute("BEGIN IMMEDIATE;")
+                return
+            except sq3.OperationalError as e:
+                # "database is locked" - блокировка занята, остальные ошибки повторять бесполезно
+                if attempt==self.write_retries or 'locked' not in str(e):
+                    raise
+                time.sleep(random.uniform(0, self.retry_delay * 2**attempt))
+
+    def _release(self, conn: sq3.Connection):
+        '''
+        Закрывает соединение и убирает его из списка открытых
+        '''
+        with self._conns_lock:
+            if conn in self._conns:
+                self._conns.remove(conn)
+        conn.close()
+
+    def _reader(self) -> sq3.Connection:
+        '''
+        Соединение для чтения. Без replica - то же, что _connect(); в режиме replica - соединение
+        текущего потока с копией БД в памяти, которое переоткрывается после каждого обновления копии
+        '''
+        if self.replica is None:
+            return self._connect()
+        if self._replica is None or self._replica[0]!=self.dbfile:
+            self.refresh_replica()
+        with self._replica_lock:
+            # Под блокировкой: старую копию освобождают только после замены, а к освобождённой
+            #    копии по тому же имени подключилась бы новая пустая БД
+            name = self._replica[1]
+            conn = getattr(self._local, 'replica_conn', None)
+            if conn is not None:
+                if self._local.replica_name==name:
+                    return conn
+                self._release(conn)
+            if self._stats is None:
+                conn = sq3.connect(name, uri=True, check_same_thread=False, cached_statements=self.cached_statements)
+            else:
+                conn = sq3.connect(name, uri=True, check_same_thread=False, cached_statements=self.cached_statements,
+                    factory=_TracedConnection)
+                conn.stats = self._stats
+        conn.execute("PRAGMA query_only = 1;")
+        self._local.replica_conn, self._local.replica_name = conn, name
+        self._local.data_version = None
+        with self._conns_lock:
+            self._conns.append(conn)
+        return conn
+
+    def refresh_replica(self, force: bool = True) -> bool:
+        '''
+        Загружает копию БД в память (режим replica): новая копия собирается через backup рядом со
+        старой, и только затем читатели переключаются на неё, так что чтение не ждёт загрузки.
+        force=False - только если файл изменился с прошлой загрузки (PRAGMA data_version отдельного
+        соединения меняется при любой записи в файл - этим объектом, другими потоками и процессами).
+        Вернет True, если копия обновлена.
+        Запись всегда идёт в файл, а в копии появляется после обновления: при replica>0 его каждые
+        replica секунд проверяет фоновый поток. Памяти копия занимает примерно как файл БД
+        '''
+        with self._refresh_lock:
+            dbfile, old = self.dbfile, self._replica
+            if old is not None and old[0]==dbfile:
+                watch = old[3]
+            else:
+                self._connect()
+                watch = sq3.connect(dbfile, check_same_thread=False)
+            version = watch.execute(SQL['data_version']).fetchone()[0]
+            if not force and old is not None and watch is old[3] and version==old[4]:
+                return False
+
+            self._replica_gen += 1
+            name = 'file:telfbook-replica-{0}-{1}?mode=memory&cache=shared'.format(id(self), self._replica_gen)
+            anchor = sq3.connect(name, uri=True, check_same_thread=False)
+            try:
+                self.backup(anchor)
+            except BaseException:
+                anchor.close()
+                if old is None or watch is not old[3]:
+                    watch.close()
+                raise
+            with self._replica_lock:
+                self._replica = (dbfile, name, anchor, watch, version)
+            if old is not None:
+                old[2].close()
+                if old[3] is not watch:
+                    old[3].close()
+            self._cache_invalidate()
+
+            if self.replica and self._replica_thread is None:
+                self._replica_stop = threading.Event()
+                self._replica_thread = threading.Thread(target=self._watch_replica, args=(self._replica_stop,),
+                    name='telfbook-replica', daemon=True)
+                self._replica_thread.start()
+        return True
+
+    def _watch_replica(self, stop: threading.Event):
+        '''
+        Фоновый поток режима replica: каждые replica секунд обновляет копию, если файл изменился
+        '''
+        while not stop.wait(self.replica):
+            try:
+                self.refresh_replica(force=False)
+            except sq3.Error as e:
+                import logging
+                logging.getLogger(__name__).warning('replica refresh failed: %s', e)
+
+    def close(self):
+        '''
+        Закрывает все соединения с БД, открытые объектом (во всех потоках). После close() объект
+        можно использовать дальше - соединение откроется заново при следующем обращении
+        '''
+        if self._replica_thread is not None:
+            self._replica_stop.set()
+            self._replica_thread.join()
+            self._replica_thread = None
+        with self._refresh_lock:
+            if self._replica is not None:
+                self._replica[2].close()
+                self._replica[3].close()
+                self._replica = None
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            conn.close()
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def new_card(self, crd: dict):
+        '''
+        Добавление нового элемента в базу данных. В словаре crd обязательно только поле 'name'. Все
+        поля должны быть текстовыми. Поля, которые будут внесены в карточку:
+        'name', 'tlf1', 'comment1', 'tlf2', 'comment2', 'tlf3', 'comment3', 'adr', 'job', 
+        'mail', 'site', 'comment'
+        Остальные ключи - игнорируются
+        '''
+        res = 0
+        if 'name' in crd:
+
+            crdkeys, crditems = self._card_row(crd, timestamp())
+
+            conn = self._connect()
+            curs = conn.cursor()
+            self._begin(conn)
+            try:
+                curs.execute(sql_insert(crdkeys), crditems)
+                # lastrowid после вставки телефонов - уже rowid таблицы phones
+                card_id = curs.lastrowid
+                self._index_phones(curs, card_id, crd)
+                self._index_name(curs, card_id, crd['name'])
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+        else: 
+            return 1
+        
+    @staticmethod
+    def _card_row(crd: dict, stamp: str) -> tuple:
+        '''
+        Очищает словарь карточки от лишних полей. Вернет кортеж допустимых ключей из crd и список их
+        значений. Даты создания и изменения, если их нет в crd, заполняются значением stamp
+        '''
+        my_keys = {'name', 'tlf1', 'comment1', 'tlf2', 'comment2', 'tlf3', 'comment3', 'adr', 'job', 
+            'mail', 'site', 'comment', 'cr_dt', 'upd_dt'}
+        crdkeys = [i for i in list(crd.keys()) if i in my_keys]
+        crditems = [crd[i] for i in crdkeys]
+        for i in ['cr_dt', 'upd_dt']:
+            if i not in crd:
+                crdkeys.append(i)
+                crditems.append(stamp)
+        return tuple(crdkeys), crditems
+
+    def new_cards(self, cards, batch_size: int = 1000, defer_indexes: bool = False) -> tuple:
+        '''
+        Массовое добавление карточек. cards - любой итерируемый объект (в т.ч. генератор) словарей
+        в формате new_card. Карточки пишутся пачками по batch_size, каждая пачка - одна транзакция.
+        defer_indexes=True отключает обновление индексов (номера телефонов, полнотекстовый) на время
+        загрузки и перестраивает их в конце - быстрее для больших импортов.
+        Вернет кортеж (ids, errors): список id добавленных карточек и список пар
+        (номер карточки в cards, текст ошибки) для карточек, которые добавить не удалось
+        '''
+        ids, errors = [], []
+        for batch_ids, batch_errors in self._insert_stream(cards, batch_size, defer_indexes):
+            ids.extend(batch_ids)
+            errors.extend(batch_errors)
+        return ids, errors
+
+    def _insert_stream(self, cards, batch_size: int, defer_indexes: bool):
+        '''
+        Генератор для new_cards: пишет карточки пачками и после каждой пачки выдаёт пару
+        (id добавленных карточек, ошибки). Позволяет загружать сколь угодно большие потоки
+        карточек, не накапливая id в памяти
+        '''
+        conn = self._connect()
+        curs = conn.cursor()
+
+        deferred = []
+        if defer_indexes:
+            # Запоминаем определения индексов и триггера FTS в самом файле, чтобы восстановить их в
+            #    конце, а если процесс не доживёт до конца - при следующем открытии файла
+            self._begin(conn)
+            try:
+                deferred = curs.execute(SQL['deferred_find']).fetchall()
+                curs.executemany(SQL['deferred_add'], deferred)
+                for tp, name, _ in deferred:
+                    curs.execute("DROP {0} {1};".format(tp.upper(), name))
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+        try:
+            batch, ids, errors = [], [], []
+            for num, crd in enumerate(cards):
+                if not isinstance(crd, collections.abc.Mapping) or 'name' not in crd:
+                    errors.append((num, "no 'name' field"))
+                    continue
+                batch.append((num, crd))
+                if len(batch)>=batch_size:
+                    self._insert_batch(conn, batch, ids, errors)
+                    yield ids, errors
+                    batch, ids, errors = [], [], []
+            if batch:
+                self._insert_batch(conn, batch, ids, errors)
+            yield ids, errors
+        finally:
+            if deferred:
+                self._restore_deferred(conn)
+
+    def _restore_deferred(self, conn: sq3.Connection):
+        '''
+        Восстанавливает индексы и триггер FTS, записанные в deferred_schema, и перестраивает
+        полнотекстовый индекс, если без триггера в cards добавлялись строки. Уже восстановленное
+        (например, другим процессом) пропускается
+        '''
+        curs = conn.cursor()
+        self._begin(conn)
+        try:
+            deferred = curs.execute(SQL['deferred_list']).fetchall()
+            curs.execute("SELECT name FROM sqlite_master WHERE type IN ('index', 'trigger');")
+            existing = {i[0] for i in curs.fetchall()}
+            missing = [(tp, sql) for tp, name, sql in deferred if name not in existing]
+            for _, sql in missing:
+                curs.execute(sql)
+            if any(tp=='trigger' for tp, _ in missing):
+                curs.execute("INSERT INTO cards_fts(cards_fts) VALUES ('rebuild');")
+            curs.execute(SQL['deferred_clear'])
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def _insert_batch(self, conn: sq3.Connection, batch: list, ids: list, errors: list):
+        '''
+        Записывает пачку карточек [(номер, словарь), ...] одной транзакцией. Карточки с одинаковым
+        набором полей вставляются одним executemany. Если пачка не записалась целиком, она
+        повторяется по одной карточке, чтобы найти и отчитаться об ошибочных
+        '''
+        stamp = timestamp()
+        groups = {}
+        for num, crd in batch:
+            crdkeys, crditems = self._card_row(crd, stamp)
+            groups.setdefault(crdkeys, []).append((num, crd, crditems))
+
+        curs = conn.cursor()
+        # Запись идёт под блокировкой транзакции без явных id, поэтому AUTOINCREMENT выдаёт новым
+        #    строкам подряд идущие номера. Блокировку не удалось взять - ошибка всей загрузки, а не
+        #    карточек: повтор по одной только ждал бы её заново для каждой
+        self._begin(conn)
+        try:
+            new_ids = []
+            for crdkeys, rows in groups.items():
+                curs.execute(SQL['cards_seq'])
+                seq = curs.fetchone()
+                first = (seq[0] if seq else 0) + 1
+                curs.executemany(sql_insert(crdkeys), [crditems for _, _, crditems in rows])
+                new_ids.extend(zip(range(first, first+len(rows)), rows))
+            curs.executemany(
+                SQL['phones_insert'],
+                [(card_id, slot, digits, digits[::-1])
+                    for card_id, (_, crd, _) in new_ids
+                    for slot, digits in enumerate([normalize_phone(crd.get(i, '')) for i in ['tlf1', 'tlf2', 'tlf3']], 1)
+                    if digits]
+            )
+            self._index_keys(curs, [(card_id, fuzzy_key(crd['name'])) for card_id, (_, crd, _) in new_ids])
+            conn.commit()
+            # id возвращаются в порядке следования карточек во входных данных
+            ids.extend([card_id for card_id, _ in sorted(new_ids, key=lambda x: x[1][0])])
+        except sq3.Error as e:
+            conn.rollback()
+            if len(batch)==1:
+                errors.append((batch[0][0], str(e)))
+            else:
+                for item in batch:
+                    self._insert_batch(conn, [item], ids, errors)
+
+    def row_count(self) -> int:
+        '''
+        Вернёт общее количество записей в БД
+        '''
+        conn = self._reader()
+        curs = conn.cursor()
+        curs.execute(SQL['row_count'])
+        rsp = curs.fetchall()[0][0]
+        conn.commit()
+        return rsp     
+
+    def avail_id(self, limit: int = None) -> list:
+        '''
+        Вернет список доступных id. limit - ограничение длины списка (первые limit id)
+        '''
+        conn = self._reader()
+        curs = conn.cursor()
+        curs.execute(SQL['avail_id'], (-1 if limit is None else int(limit),))
+        rsp = curs.fetchall()
+        conn.commit()
+        return [i[0] for i in rsp]
+
+    def has_card(self, card_id: int) -> bool:
+        '''
+        Проверка существования карточки с указанным id. Один поиск по первичному ключу, без
+        выборки всех id
+        '''
+        conn = self._reader()
+        curs = conn.cursor()
+        curs.execute(SQL['has_card'], (card_id,))
+        return curs.fetchone() is not None
+
+    def delete_card(self, card_id: int):
+        '''
+        Удалит карточку с указанным id. Вернет 0 при удачном удалении, и 1 если такого id нет
+        '''
+        conn = self._connect()
+        curs = conn.cursor()
+        self._begin(conn)
+        try:
+            curs.execute(SQL['delete_card'], (card_id,))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        self._cache_invalidate(card_id)
+        # Число удалённых строк заменяет отдельную проверку существования id
+        return 0 if curs.rowcount>0 else 1
+
+    def get_card(self, card_id: int, columns=None) -> Card:
+        '''
+        Вернёт карточку (Card) по заданному id. Если такого id нет - вернет пустой словарь.
+        columns - читать только эти поля (мимо кэша карточек)
+        '''
+        cols = self._columns(columns)
+        conn = self._reader()
+        cached = self._cache is not None and cols==CARD_COLUMNS
+        if cached:
+            self._check_data_version(conn)
+            key = (self.dbfile, str(card_id))
+            # Карточка неизменяема, поэтому из кэша отдаётся без копирования
+            crd = self._cache.get(key)
+            if crd is not None:
+                return crd
+            generation = self._cache.generation
+
+        curs = conn.cursor()
+        curs.execute(sql_select('get_card', cols), (card_id,))
+        rsp = curs.fetchone()
+        if rsp is None:
+            return dict()
+
+        crd = Card.from_rows([rsp], cols)[0]
+        if cached:
+            self._cache.put(key, crd, generation)
+        return crd
+
+    @staticmethod
+    def _columns(columns) -> tuple:
+        '''
+        Набор столбцов для выборки: все (None) или указанные, id - всегда и первым, остальные - в
+        порядке столбцов таблицы. Неизвестное поле - ValueError
+        '''
+        if columns is None:
+            return CARD_COLUMNS
+        unknown = set(columns) - set(CARD_KEYS)
+        if unknown:
+            raise ValueError('unknown card fields: {0}'.format(', '.join(sorted(unknown))))
+        return tuple([i for i in CARD_KEYS if i=='id' or i in columns])
+
+    def _check_data_version(self, conn: sq3.Connection):
+        '''
+        Убирает из кэша карточки, изменённые другими соединениями: другими потоками этого объекта
+        (соединения у потоков свои) или другими процессами. PRAGMA data_version соединения
+        меняется при любой чужой записи, и тогда изменённые карточки берутся из журнала changes
+        после последней уже учтённой записи - свои изменения этого объекта там тоже есть, но их
+        методы записи уже убрали сами. Кэш сбрасывается целиком, только если журнал не покрывает
+        весь промежуток (обрезан trim_changes, файл заменён) или изменений больше, чем мест в кэше
+        '''
+        version = conn.execute(SQL['data_version']).fetchone()[0]
+        if version==self._local.data_version:
+            return
+        self._local.data_version = version
+        with self._cache_seq_lock:
+            last = conn.execute(SQL['changes_last']).fetchone()
+            last = last[0] if last else 0
+            seq = self._cache_seq.get(self.dbfile)
+            if seq==last:
+                return
+            ids = []
+            if seq is not None and seq<last and last - seq<=self._cache.maxsize:
+                ids = conn.execute(SQL['changes_cards'], (seq, last)).fetchall()
+            # Номера записей журнала идут подряд, пропуски - только от обрезки журнала
+            if seq is not None and len(ids)==last - seq:
+                for card_id in set(i[0] for i in ids):
+                    self._cache_invalidate(card_id)
+            elif seq is not None or self._cache.stats()['size']>0:
+                self._cache.invalidate()
+            self._cache_seq[self.dbfile] = last
+
+    def _cache_invalidate(self, card_id=None):
+        '''
+        Удаляет карточку card_id из кэша (без card_id - очищает весь кэш)
+        '''
+        if self._cache is not None:
+            self._cache.invalidate(None if card_id is None else (self.dbfile, str(card_id)))
+
+    def cache_stats(self) -> dict:
+        '''
+        Счётчики кэша карточек: размер, попадания, промахи, вытеснения, сбросы. Без кэша - пустой словарь
+        '''
+        return self._cache.stats() if self._cache is not None else dict()
+
+    def stats(self, reset: bool = False) -> dict:
+        '''
+        Снимок замеров (см. QueryStats.snapshot): по каждому методу - количество вызовов, суммарное,
+        среднее и наибольшее время и гистограмма задержек; по каждому тексту запроса SQL - количество
+        выполнений, суммарное и наибольшее время; последние медленные запросы с планами.
+        reset - обнулить счётчики после снимка. Без instrument вернёт пустой словарь
+        '''
+        return self._stats.snapshot(reset) if self._stats is not None else {}
+
+    def update_card(self, card_id: int, column_to_update: str, new_value: str) -> int:
+        '''
+        Изменяет поле column_to_update в карточке с card_id на значение new_value.
+        Функция вернет 0 при удачной корректировке поля, и 1 при неудаче
+        Допустимые для изменения поля:
+        'name', 'tlf1', 'comment1', 'tlf2', 'comment2', 'tlf3', 'comment3', 'adr', 'job', 'mail', 'site', 'comment'
+        '''
+        return self.update_fields(card_id, {column_to_update: new_value})
+
+    def update_fields(self, card_id: int, fields: dict) -> int:
+        '''
+        Изменяет сразу несколько полей карточки card_id одним запросом UPDATE с одной отметкой
+        времени изменения. fields - словарь {поле: новое значение}, допустимые поля - как в update_card.
+        Функция вернет 0 при удачной корректировке, и 1 при неудаче (нет карточки, пустой словарь или
+        недопустимое поле - тогда не меняется ничего)
+        '''
+        conn = self._connect()
+        curs = conn.cursor()
+        self._begin(conn)
+        try:
+            res = self._update_row(curs, card_id, fields, timestamp())
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        self._cache_invalidate(card_id)
+        return res
+
+    def update_cards(self, changes, batch_size: int = 1000) -> int:
+        '''
+        Массовое изменение карточек. changes - словарь {id: {поле: значение}} или итерируемый объект
+        пар (id, {поле: значение}). Изменения пишутся пачками по batch_size, каждая пачка - одна
+        транзакция. Вернет количество изменённых карточек
+        '''
+        if isinstance(changes, dict):
+            changes = changes.items()
+        conn = self._connect()
+        curs = conn.cursor()
+        stamp = timestamp()
+        count, batch = 0, []
+        try:
+            for card_id, fields in changes:
+                if not batch:
+                    self._begin(conn)
+                count += 1 - self._update_row(curs, card_id, fields, stamp)
+                batch.append(card_id)
+                if len(batch)>=batch_size:
+                    conn.commit()
+                    for i in batch:
+                        self._cache_invalidate(i)
+                    batch = []
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        for i in batch:
+            self._cache_invalidate(i)
+        return count
+
+    def _update_row(self, curs: sq3.Cursor, card_id: int, fields: dict, stamp: str) -> int:
+        '''
+        Один параметризованный UPDATE нескольких полей карточки в транзакции вызывающего метода.
+        Вернет 0 при удаче и 1 при неудаче, как update_card. Карточку из кэша вызывающий метод
+        убирает после commit: иначе другой поток успел бы вернуть в кэш ещё не изменённую карточку
+        '''
+        my_keys = {'name', 'tlf1', 'comment1', 'tlf2', 'comment2', 'tlf3', 'comment3', 'adr', 'job', 
+            'mail', 'site', 'comment'}
+        if not fields or not set(fields).issubset(my_keys):
+            return 1
+        cols = tuple(fields)
+        curs.execute(sql_update(cols), [fields[i] for i in cols] + [stamp, card_id])
+        if curs.rowcount==0:
+            return 1
+        self._index_phones(curs, card_id, fields)
+        if 'name' in fields:
+            self._index_name(curs, card_id, fields['name'])
+        return 0
+
+    def search(self, pattern: str, mode: str = 'like', ignore_case: bool = True, limit: int = None,
+            columns=None) -> list:
+        '''
+        Поиск шаблона pattern в карточках. Вернет список карточек (Card)
+        mode='like' - поиск подстроки во всех полях (полный просмотр таблицы, регистр учитывается
+            только для не-латинских букв - так работает LIKE в sqlite)
+        mode='fts' - поиск по полнотекстовому индексу: каждое слово шаблона ищется как начало слова
+            в карточке, результат упорядочен по релевантности (bm25). ignore_case=False оставит
+            только карточки, где слова шаблона встречаются с точным регистром. Если FTS5
+            недоступен, выполняется поиск LIKE
+        mode='fuzzy' - нечёткий поиск по имени (см. search_fuzzy), не более limit (по умолчанию 20) карточек
+        limit - ограничение количества найденных карточек, columns - читать только эти поля
+        '''
+        cols = self._columns(columns)
+        # Соединение открывается до проверки _schema_ready: при lazy=True схема ещё не проверена
+        conn = self._reader()
+        if mode=='fts' and self._schema_ready.get(self.dbfile):
+            return self._search_fts(pattern, ignore_case, limit, cols)
+        if mode=='fuzzy':
+            return [i[1] for i in self.search_fuzzy(pattern, limit=20 if limit is None else limit, columns=columns)]
+
+        curs = conn.cursor()
+        curs.execute(sql_select('search', cols), self._like_params(pattern) + [-1 if limit is None else int(limit)])
+        rsp = curs.fetchall()
+        conn.commit()        
+        # Оформляем результат поиска
+        return Card.from_rows(rsp, cols)
+
+    @staticmethod
+    def _like_params(pattern: str) -> list:
+        '''
+        Параметры условия поиска подстроки pattern во всех полях карточки
+        '''
+        return ['%'+str(pattern)+'%']*len(_LIKE_KEYS)
+
+    @staticmethod
+    def _fts_query(pattern: str) -> tuple:
+        '''
+        Разбивает шаблон на слова и строит по ним запрос MATCH для FTS5: слова объединяются по И,
+        каждое - как префикс. Вернет кортеж (запрос, список слов); запрос None, если слов нет
+        '''
+        words = ''.join([(c if c.isalnum() else ' ') for c in str(pattern)]).split()
+        # Кавычки экранируют служебные слова FTS5 (AND, OR, NEAR), * - поиск по префиксу
+        return (' '.join(['"{0}"*'.format(i) for i in words]) or None), words
+
+    def _search_fts(self, pattern: str, ignore_case: bool, limit: int, cols: tuple = CARD_COLUMNS) -> list:
+        '''
+        Поиск по индексу cards_fts. Слова шаблона объединяются по И, каждое - как префикс
+        '''
+        rqmatch, words = self._fts_query(pattern)
+        if rqmatch is None:
+            return []
+        # Для проверки регистра нужны все проиндексированные поля, даже если их не просили
+        fetch = cols if ignore_case else self._columns(set(cols) | set(self.fts_columns))
+        curs = self._reader().cursor()
+        curs.execute(sql_select('search_fts', fetch), (rqmatch, -1 if limit is None else int(limit)))
+        res = Card.from_rows(curs.fetchall(), fetch)
+        if not ignore_case:
+            res = [i for i in res if all(any(w in str(i[k]) for k in self.fts_columns) for w in words)]
+            if fetch!=cols:
+                res = [Card([i[k] for k in cols], cols) for i in res]
+        return res
+
+    def search_fuzzy(self, query: str, threshold: float = 0.45, limit: int = 20, columns=None) -> list:
+        '''
+        Нечёткий поиск по имени, устойчивый к опечаткам и к записи имени латиницей вместо кириллицы.
+        Похожесть - доля общих триграмм (коэффициент Дайса, от 0 до 1; порог 0.45 соответствует
+        порогу 0.3 по Жаккару, принятому в pg_trgm). Вернет не более limit пар
+        (похожесть, карточка) с похожестью не меньше threshold, по убыванию похожести.
+        columns - как в search
+        Поиск приближённый: кандидаты - карточки, в имени которых есть слово, похожее на слово
+        запроса, и просматривается не больше fuzzy_card_scan таких карточек (см. _similar_words)
+        '''
+        key = fuzzy_key(query)
+        qtri = trigrams(key)
+        if not qtri:
+            return []
+        curs = self._reader().cursor()
+
+        # Похожие слова каждого слова запроса, все вместе - по убыванию наибольшей похожести имени
+        similar = {}
+        for word in dict.fromkeys(key.split()):
+            similar[word] = self._similar_words(curs, word, threshold, len(qtri - trigrams(word)))
+        order = sorted([(best, cards, cword, word) for word, words in similar.items() for best, cards, cword in words],
+            key=lambda x: (-x[0], x[1], x[2]))
+
+        # Похожесть не меньше threshold возможна только при числе триграмм имени n в пределах
+        #    nq*t/(2-t) <= n <= nq*(2-t)/t: общих триграмм не больше меньшего из двух чисел
+        nq = len(qtri)
+        low = math.ceil(nq * threshold / (2 - threshold) - 1e-9)
+        high = math.floor(nq * (2 - threshold) / threshold + 1e-9)
+        found, common, top, done = {}, {}, [], set()
+
+        def read(sql, params):
+            for card_id, ckey, n in curs.execute(sql, params).fetchall():
+                if card_id in found:
+                    continue
+                # Оценка общих триграмм - сумма по словам имени, посчитанная для каждого слова один раз
+                total = 0
+                for cword in ckey.split():
+                    count = common.get(cword)
+                    if count is None:
+                        count = common[cword] = len(qtri & word_trigrams(cword))
+                    total += count
+                score = 2 * total / (nq + n)
+                found[card_id] = (score, ckey)
+                # limit лучших оценок, top[0] - худшая из них
+                if len(top)<limit:
+                    heapq.heappush(top, score)
+                else:
+                    heapq.heappushpop(top, score)
+
+        def read_words(words):
+            if words:
+                read(SQL['fuzzy_cards_by_words'].format(', '.join(['?']*len(words))), words + [low, high, self.fuzzy_card_scan])
+
+        # Слова с наибольшей возможной похожестью имени - первыми, пока она выше limit-й лучшей
+        #    оценки. Карточки редких слов читаются вместе, порциями примерно по 4*limit, всего не
+        #    больше fuzzy_card_scan. У частого слова (обычно имени) читаются только карточки, где
+        #    есть и самое похожее слово к другому слову запроса, и то лишь если у того карточек
+        #    ещё больше - иначе их прочитает оно само
+        left, words, pending = self.fuzzy_card_scan, [], 0
+        for bound, cards, cword, word in order:
+            if left<=0 or len(top)==limit and bound<=top[0]:
+                break
+            if cword in done:
+                continue
+            done.add(cword)
+            if cards<=left:
+                words.append(cword)
+                left -= cards
+                pending += cards
+                if pending>=4*limit:
+                    read_words(words)
+                    words, pending = [], 0
+                continue
+            others = [i[0] for w, i in similar.items() if w!=word and i]
+            if others and min(i[1] for i in others)<cards:
+                continue
+            read_words(words)
+            words, pending = [], 0
+            # Список карточек частого слова обрезается пределом, поэтому сначала читаются имена,
+            #    ближайшие по длине к имени из этого слова и слов others: половина предела - на
+            #    имена короче, половина - на имена не короче его
+            target = len(word_trigrams(cword)) + sum(len(word_trigrams(i[2])) for i in others)
+            params = [cword, low, target - 1, left // 2, cword, target, high, left - left // 2]
+            if others:
+                cond = SQL['fuzzy_with_words'].format(', '.join(['?']*len(others)))
+                read(SQL['fuzzy_cards_by_word'].format(cond), params + [i[2] for i in others])
+            else:
+                read(SQL['fuzzy_cards_by_word'].format(''), params)
+            left = 0
+        read_words(words)
+
+        # Оценка не меньше точной похожести (у слов одного имени бывают общие триграммы), поэтому
+        #    точно пересчитываются вдвое больше лучших по оценке карточек, чем нужно вернуть
+        best = sorted(found.items(), key=lambda x: (-x[1][0], x[0]))[:2*limit]
+        scored = []
+        for card_id, (_, ckey) in best:
+            ctri = trigrams(ckey)
+            score = 2 * len(qtri & ctri) / (nq + len(ctri))
+            if score>=threshold:
+                scored.append((score, card_id))
+        scored = sorted(scored, key=lambda x: (-x[0], x[1]))[:limit]
+
+        if not scored:
+            return []
+        cols = self._columns(columns)
+        curs.execute(sql_select('cards_by_ids', cols).format(', '.join(['?']*len(scored))), [i[1] for i in scored])
+        cards = {i['id']: i for i in Card.from_rows(curs.fetchall(), cols)}
+        return [(score, cards[card_id]) for score, card_id in scored if card_id in cards]
+
+    def _similar_words(self, curs: sq3.Cursor, word: str, threshold: float, rest: int = 0) -> list:
         '''
-        В начале, просто проверяем существование файла базы данных, создаём его если не существует
+        Слова словаря, с которыми имя может быть похоже на запрос не меньше чем на threshold, если
+        остальные слова имени совпадут с остальными словами запроса (rest - число их триграмм).
+        Вернет список (наибольшая похожесть имени, число карточек, слово) по убыванию похожести,
+        при равной - сначала редкие слова. Короткое слово с парой общих триграмм даёт имени большую
+        похожесть, чем длинное с тем же числом общих, поэтому слова упорядочены по похожести имени,
+        а не самих слов. Списки word_trigrams читаются от коротких к длинным (более выгодные длины
+        слова - первыми), всего не больше fuzzy_word_scan строк
         '''
-        # Имя файла базы данных
-        self.dbfile = dbfilename
+        wtri = trigrams(word)
+        nw = len(wtri)
 
-        conn = sq3.connect(self.dbfile)
-        curs = conn.cursor()
-        
-        rownames = [
-            "id INTEGER PRIMARY KEY AUTOINCREMENT, ", # ID карточки
-            "name TEXT NOT NULL, ", # ФИО
-            "tlf1 TEXT DEFAULT 'undefined', ", # Первый телефон
-            "comment1 TEXT DEFAULT '', ", # Комментарий к первому телефону
-            "tlf2 TEXT DEFAULT '', ", # Второй телефон
-            "comment2 TEXT DEFAULT '', ", # Комментарий ко второму телефону
-            "tlf3 TEXT DEFAULT '', ", # Третий телефон
-            "comment3 TEXT DEFAULT '', ", # Комментарий к третьему телефону
-            "adr TEXT DEFAULT '', ", # Адрес
-            "job TEXT DEFAULT '', ", # Место работы
-            "mail TEXT DEFAULT '', ", # Электронная почта
-            "site TEXT DEFAULT '', ", # Сайт
-            "comment TEXT DEFAULT 'No comment', ", # Комментарий
-            "cr_dt TEXT, ", # Дата создания карточки
-            "upd_dt TEXT" # Дата последнего изменения
-        ]
-        rqtosq3 = "CREATE TABLE IF NOT EXISTS cards ({0});".format(ft.reduce((lambda x, y: x+y), rownames))
-        curs.execute(rqtosq3)
-        conn.commit()
+        def best(common, n):
+            # Похожесть имени из слова с n триграммами, common из них общих, и остальных слов запроса
+            return 2 * (common + rest) / (nw + n + 2 * rest)
 
-    def new_card(self, crd: dict):
+        curs.execute(SQL['fuzzy_word_df'].format(', '.join(['?']*nw)), list(wtri))
+        lists = {}
+        for tri, n, df in curs.fetchall():
+            if best(min(nw, n), n)>=threshold:
+                lists.setdefault(n, []).append((df, tri))
+        lists = {n: sorted(tris) for n, tris in lists.items()}
+        lengths = sorted(lists, key=lambda n: (-best(min(nw, n), n), n))
+
+        plan, left = {}, self.fuzzy_word_scan
+        for rank in range(nw):
+            for n in lengths:
+                if rank<len(lists[n]) and lists[n][rank][0]<=left:
+                    left -= lists[n][rank][0]
+                    plan.setdefault(n, []).append(lists[n][rank][1])
+
+        # Похожесть по маскам триграмм считается без разбора слов на триграммы; точно
+        #    пересчитываются только 64 лучших по ней слова
+        wmask = trigram_mask(wtri)
+        guess = {}
+        for n, tris in plan.items():
+            curs.execute(SQL['fuzzy_words_by_tri'].format(', '.join(['?']*len(tris))), [n] + tris)
+            for cword, mask in curs.fetchall():
+                guess[cword] = best(bin(wmask & mask).count('1'), n)
+        similar = {}
+        for cword in sorted(guess, key=lambda x: -guess[x])[:64]:
+            ctri = word_trigrams(cword)
+            score = best(len(wtri & ctri), len(ctri))
+            if score>=threshold:
+                similar[cword] = score
+        if not similar:
+            return []
+        curs.execute(SQL['fuzzy_word_cards'].format(', '.join(['?']*len(similar))), list(similar))
+        return sorted([(similar[cword], cards, cword) for cword, cards in curs.fetchall()], key=lambda x: (-x[0], x[1], x[2]))
+
+    def search_page(self, pattern: str = '', after=None, page_size: int = 50, mode: str = 'like',
+            columns=None) -> tuple:
         '''
-        Добавление нового элемента в базу данных. В словаре crd обязательно только поле 'name'. Все
-        поля должны быть текстовыми. Поля, которые будут внесены в карточку:
-        'name', 'tlf1', 'comment1', 'tlf2', 'comment2', 'tlf3', 'comment3', 'adr', 'job', 
-        'mail', 'site', 'comment'
-        Остальные ключи - игнорируются
+        Одна страница результатов поиска (или всех карточек, если pattern пустой). Вернет кортеж
+        (список карточек, продолжение). Продолжение передаётся в after для получения
+        следующей страницы; None - страниц больше нет. Страница выбирается по ключу (id или
+        релевантность и id), без OFFSET, поэтому каждая следующая страница не дороже первой.
+        mode - как в search: 'like' - по возрастанию id, 'fts' - по релевантности; columns - как в search
         '''
-        res = 0
-        if 'name' in crd:
+        cols = self._columns(columns)
+        curs = self._reader().cursor()
+        if pattern and mode=='fts' and self._schema_ready.get(self.dbfile):
+            rqmatch, words = self._fts_query(pattern)
+            if rqmatch is None:
+                return [], None
+            # Ключ страницы - пара (релевантность, id)
+            score, last_id = after if after is not None else (float('-inf'), -1)
+            curs.execute(sql_select('page_fts', cols), (rqmatch, score, last_id, page_size+1))
+            rsp = curs.fetchall()
+            res = Card.from_rows([i[:-1] for i in rsp[:page_size]], cols)
+            nxt = (rsp[page_size-1][-1], rsp[page_size-1][0]) if len(rsp)>page_size else None
+            return res, nxt
 
-            # Очищаем словарь от лишних полей. Собираем допустимые ключи из crd и их значения в отдельные списки
-            my_keys = {'name', 'tlf1', 'comment1', 'tlf2', 'comment2', 'tlf3', 'comment3', 'adr', 'job', 
-                'mail', 'site', 'comment', 'cr_dt', 'upd_dt'}
-            crdkeys = [i for i in list(crd.keys()) if i in my_keys]
-            crditems = [crd[i] for i in crdkeys] + ['{0}-{1}-{2} {3}:{4}:{5}'.format(*now())]*2
-            crdkeys.extend(['cr_dt', 'upd_dt'])
-
-            # Формируем запрос к БД
-            rq_cols = ", ".join([str(i) for i in crdkeys])
-            rq_items = ", ".join(["'"+str(i)+"'" for i in crditems])
-            
-            conn = sq3.connect(self.dbfile)
-            curs = conn.cursor()
+        rqpage, params = ('page_like', self._like_params(pattern)) if pattern else ('page', [])
+        curs.execute(sql_select(rqpage, cols), params + [after if after is not None else -1, page_size+1])
+        rsp = curs.fetchall()
+        res = Card.from_rows(rsp[:page_size], cols)
+        return res, (res[-1]['id'] if len(rsp)>page_size else None)
 
-            rtins = "INSERT INTO cards ({0}) VALUES ({1});".format(rq_cols, rq_items)
-            curs.execute(rtins)
-            conn.commit()
+    def iter_search(self, pattern: str = '', mode: str = 'like', page_size: int = 500, columns=None):
+        '''
+        Ленивый генератор результатов поиска: карточки читаются из БД страницами search_page,
+        поэтому память зависит от page_size, а не от количества найденного
+        '''
+        after = None
+        while True:
+            page, after = self.search_page(pattern, after, page_size, mode, columns)
+            yield from page
+            if after is None:
+                break
 
-        else: 
-            return 1
-        
-    def row_count(self) -> int:
+    def find_by_phone(self, number: str, suffix: int = None, columns=None) -> list:
         '''
-        Вернёт общее количество записей в БД
+        Поиск карточек по номеру телефона в любом формате ("+7 (912) 345-67-89", "89123456789").
+        Номер нормализуется так же, как при сохранении карточки, поиск идёт по индексу.
+        suffix - искать совпадение только последних suffix цифр (например, 7 - без кода города).
+        Вернет список карточек, каждая карточка - один раз; columns - как в search
         '''
-        conn = sq3.connect(self.dbfile)
-        curs = conn.cursor()
-        rqcnt = "SELECT COUNT(*) FROM cards;"
-        curs.execute(rqcnt)
-        rsp = curs.fetchall()[0][0]
-        conn.commit()
-        return rsp     
+        cols = self._columns(columns)
+        digits = normalize_phone(number)
+        if suffix is not None:
+            digits = ''.join([i for i in str(number) if i.isdigit()])[-int(suffix):]
+        if not digits:
+            return []
+        curs = self._reader().cursor()
+        if suffix is None:
+            curs.execute(sql_select('phone', cols), (digits,))
+        else:
+            # Символ ':' следует в ASCII сразу за '9' и замыкает диапазон перевёрнутых номеров
+            rdigits = digits[::-1]
+            curs.execute(sql_select('phone_suffix', cols), (rdigits, rdigits+':'))
+        return Card.from_rows(curs.fetchall(), cols)
 
-    def avail_id(self) -> list:
+    def iter_cards(self, chunk_size: int = 1000, columns=None):
         '''
-        Вернет список доступных id
+        Генератор всех карточек в порядке id. Карточки читаются из БД порциями по chunk_size
+        (по первичному ключу, начиная с последнего прочитанного id), поэтому память не зависит
+        от размера таблицы
         '''
-        conn = sq3.connect(self.dbfile)
-        curs = conn.cursor()
-        rqavid = "SELECT id FROM cards;"
-        curs.execute(rqavid)
-        rsp = curs.fetchall()
-        conn.commit()
-        return [i[0] for i in rsp]
+        return self.iter_search(page_size=chunk_size, columns=columns)
 
-    def delete_card(self, card_id: int):
+    def export_file(self, filename: str, fmt: str = None, version: str = '3.0') -> tuple:
         '''
-        Удалит карточку с указанным id
+        Выгрузка всех карточек в файл. fmt - 'csv', 'jsonl' или 'vcf' (по умолчанию - по расширению
+        файла), version - версия vCard ('3.0' или '4.0').
+        Вернет кортеж (количество карточек, строк в секунду)
         '''
-        if card_id in self.avail_id():
-            conn = sq3.connect(self.dbfile)
-            curs = conn.cursor()
-            rqdc = "DELETE FROM cards WHERE id={0};".format(card_id)
-            curs.execute(rqdc)
-            #rsp = curs.fetchall()
-            conn.commit()
-            return 0
-        else:
-            return 1
+        fmt = fmt or os.path.splitext(filename)[1].lstrip('.').lower()
+        writer = FILE_FORMATS[fmt][1]
+        t0 = time.perf_counter()
+        with open(filename, 'w', encoding='utf-8', newline='') as f:
+            count = writer(f, self.iter_cards(), version) if fmt=='vcf' else writer(f, self.iter_cards())
+        return count, count / max(time.perf_counter() - t0, 1e-9)
 
-    def get_card(self, card_id: int) -> dict:
+    def import_file(self, filename: str, fmt: str = None, batch_size: int = 10000,
+            defer_indexes: bool = None) -> tuple:
         '''
-        Вернёт карточку в виде словаря по заданному id. Если такого id нет - вернет пустой словарь.
+        Загрузка карточек из файла csv, jsonl или vcf (fmt по умолчанию - по расширению файла).
+        Файл читается потоково и пишется пачками через new_cards; id из файла не сохраняются.
+        defer_indexes - как в new_cards. По умолчанию (None) индексы откладываются, только если файл
+        больше самой БД: их перестройка обходит всю книгу, и для небольшого файла она дороже загрузки.
+        Вернет кортеж (количество добавленных карточек, ошибки, строк в секунду), ошибки - как в new_cards
         '''
-        if card_id in self.avail_id():
-            conn = sq3.connect(self.dbfile)
-            curs = conn.cursor()
-            rqgetcrd = "SELECT * FROM cards WHERE id = {0};".format(card_id)
-            curs.execute(rqgetcrd)
+        if defer_indexes is None:
+            conn = self._connect()
+            book = conn.execute("PRAGMA page_count;").fetchone()[0] * conn.execute("PRAGMA page_size;").fetchone()[0]
+            defer_indexes = os.path.getsize(filename)>book
+        fmt = fmt or os.path.splitext(filename)[1].lstrip('.').lower()
+        reader = FILE_FORMATS[fmt][0]
+        count, errors = 0, []
+        t0 = time.perf_counter()
+        with open(filename, 'r', encoding='utf-8', newline='') as f:
+            for batch_ids, batch_errors in self._insert_stream(reader(f), batch_size, defer_indexes):
+                count += len(batch_ids)
+                errors.extend(batch_errors)
+        return count, errors, count / max(time.perf_counter() - t0, 1e-9)
+
+    def backup(self, dest, pages_per_step: int = 1024, progress=None, pause: float = 0.0) -> tuple:
+        '''
+        Горячая копия БД через online backup API sqlite: dest - имя файла (существующий файл
+        перезаписывается) или открытое соединение sqlite3. Копируется по pages_per_step страниц за
+        шаг (-1 - всё за один шаг), между шагами - пауза pause секунд, чтобы ограничить нагрузку на
+        диск. progress(скопировано, всего) вызывается после каждого шага.
+        Копия - согласованный снимок на момент начала: всё копирование идёт в одной читающей
+        транзакции, а в режиме WAL читатели не мешают писателям, так что запись другими потоками и
+        процессами продолжается. Без этой транзакции каждое чужое изменение начинало бы копирование
+        заново, и при постоянной записи оно могло бы не закончиться никогда.
+        Вернет кортеж (количество страниц, Мб в секунду)
+        '''
+        conn = self._connect()
+        page_size = conn.execute("PRAGMA page_size;").fetchone()[0]
+        copied = [0]
+
+        def step(status, remaining, total):
+            copied[0] = total - remaining
+            if progress is not None:
+                progress(copied[0], total)
+            if pause and remaining:
+                time.sleep(pause)
+
+        target = dest if isinstance(dest, sq3.Connection) else sq3.connect(dest)
+        t0 = time.perf_counter()
+        try:
+            conn.execute("BEGIN;")
+            conn.execute("SELECT 1 FROM sqlite_master LIMIT 1;").fetchall()
+            conn.backup(target, pages=pages_per_step, progress=step)
+        finally:
+            conn.rollback()
+            if target is not dest:
+                target.close()
+        return copied[0], copied[0] * page_size / 1048576 / max(time.perf_counter() - t0, 1e-9)
+
+    def compact(self, pages_per_step: int = 256, progress=None, pause: float = 0.0) -> tuple:
+        '''
+        Возвращает файлу БД место, освободившееся после удалений (инкрементальный VACUUM): за шаг -
+        отдельную короткую транзакцию - освобождается не больше pages_per_step страниц, между шагами
+        пауза pause секунд, так что остальные писатели ждут не дольше одного шага.
+        progress(освобождено, всего) вызывается после каждого шага.
+        Файлы, созданные без режима auto_vacuum = INCREMENTAL, при первом вызове один раз переводятся
+        в режим INCREMENTAL полным VACUUM - на это время запись в БД блокируется.
+        Вернет кортеж (количество освобождённых страниц, Мб в секунду)
+        '''
+        conn = self._connect()
+        page_size = conn.execute("PRAGMA page_size;").fetchone()[0]
+        freed = 0
+        t0 = time.perf_counter()
+        if conn.execute("PRAGMA auto_vacuum;").fetchone()[0]!=2:
+            pages = conn.execute("PRAGMA page_count;").fetchone()[0]
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+            conn.execute("VACUUM;")
+            freed = max(pages - conn.execute("PRAGMA page_count;").fetchone()[0], 0)
+            if progress is not None:
+                progress(freed, freed)
+
+        free = conn.execute("PRAGMA freelist_count;").fetchone()[0]
+        while free:
+            self._begin(conn)
+            try:
+                # incremental_vacuum(N) освобождает по странице за каждую строку результата, а
+                #    sqlite3 у PRAGMA без столбцов забирает только первую - поэтому по одной странице
+                for _ in range(min(free, pages_per_step)):
+                    conn.execute("PRAGMA incremental_vacuum(1);")
+                left = conn.execute("PRAGMA freelist_count;").fetchone()[0]
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            freed += max(free - left, 0)
+            if progress is not None:
+                progress(freed, freed + left)
+            if left>=free:
+                break
+            free = left
+            if free and pause:
+                time.sleep(pause)
+
+        # В режиме WAL файл БД укорачивается только при переносе журнала в него
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchall()
+        return freed, freed * page_size / 1048576 / max(time.perf_counter() - t0, 1e-9)
+
+    def changes_since(self, seq: int = 0, chunk_size: int = 1000):
+        '''
+        Генератор изменений карточек с номером больше seq, по возрастанию номера. Каждое изменение -
+        словарь {'seq', 'op' ('insert', 'update' или 'delete'), 'card_id', 'ts', 'card'}, где card -
+        текущее состояние карточки (None для удалённой). Для синхронизации достаточно запомнить seq
+        последнего обработанного изменения и в следующий раз продолжить с него
+        '''
+        curs = self._connect().cursor()
+        while True:
+            curs.execute(SQL['changes'], (seq, chunk_size))
             rsp = curs.fetchall()
-            conn.commit()
-            my_keys = ['id', 'name', 'tlf1', 'comment1', 'tlf2', 'comment2', 'tlf3', 'comment3', 'adr', 'job', 
-                'mail', 'site', 'comment', 'cr_dt', 'upd_dt']
+            for i in rsp:
+                yield {'seq': i[0], 'op': i[1], 'card_id': i[2], 'ts': i[3],
+                    'card': Card(i[4:]) if i[4] is not None else None}
+            if len(rsp)<chunk_size:
+                break
+            seq = rsp[-1][0]
 
-            return dict(zip(my_keys, rsp[0]))
-        else:
-            return dict()
+    def last_change(self) -> int:
+        '''
+        Номер последнего записанного в журнал изменения (0, если изменений не было)
+        '''
+        rsp = self._connect().execute(SQL['changes_last']).fetchone()
+        return rsp[0] if rsp else 0
 
-    def update_card(self, card_id: int, column_to_update: str, new_value: str) -> int:
+    def trim_changes(self, seq: int) -> int:
         '''
-        Изменяет поле column_to_update в карточке с card_id на значение new_value.
-        Функция вернет 0 при удачной корректировке поля, и 1 при неудаче
-        Допустимые для изменения поля:
-        'name', 'tlf1', 'comment1', 'tlf2', 'comment2', 'tlf3', 'comment3', 'adr', 'job', 'mail', 'site', 'comment'
+        Удаляет из журнала изменения с номером не больше seq (уже забранные всеми потребителями).
+        Вернет количество удалённых записей
         '''
-        if (card_id in self.avail_id()) and (column_to_update in {'name', 'tlf1', 'comment1', 'tlf2', 'comment2', 'tlf3',
-            'comment3', 'adr', 'job', 'mail', 'site', 'comment'}):
-            conn = sq3.connect(self.dbfile)
-            curs = conn.cursor()
-            rqupd = "UPDATE cards SET {0}='{1}', upd_dt='{3}' WHERE id={2};".format(column_to_update, new_value, card_id, '{0}-{1}-{2} {3}:{4}:{5}'.format(*now()))
-            curs.execute(rqupd)
+        conn = self._connect()
+        curs = conn.cursor()
+        self._begin(conn)
+        try:
+            curs.execute(SQL['changes_trim'], (seq,))
             conn.commit()
-            return 0
-        else:
-            return 1
+        except BaseException:
+            conn.rollback()
+            raise
+        return curs.rowcount
+
+    def find_duplicates(self, threshold: float = 0.7, max_block: int = 100, batch: int = 500):
+        '''
+        Генератор групп вероятных дублей: пары (оценка, список id по возрастанию), по убыванию оценки.
+        Сравниваются не все пары карточек, а только карточки из одного блока - с общим номером
+        телефона (в любом слоте и формате), одинаковой почтой или одинаковым набором слов имени
+        (блоки по имени нужны, только если threshold не выше веса имени в dup_weights).
+        Блоки строит sqlite группировкой по индексам, таблица читается потоком, в памяти - только
+        карточки из блоков. Блоки больше max_block (например, общий номер организации) пропускаются.
+        Пары с оценкой (см. dup_weights) не ниже threshold связываются в группы; оценка группы -
+        средняя по её парам. Для слияния группы - merge_cards(ids)
+        '''
+        conn = self._connect()
+        conn.create_function('name_block', 1, name_block, deterministic=True)
+        parent, scored, edges = {}, set(), []
+
+        # Группы - множества, связанные парами выше порога (система непересекающихся множеств)
+        def find(x):
+            root = x
+            while parent.get(root, root)!=root:
+                root = parent[root]
+            while x!=root:
+                parent[x], x = root, parent[x]
+            return root
+
+        def score_blocks(blocks):
+            ids = sorted({i for block in blocks for i in block})
+            curs = conn.execute(SQL['dup_features'].format(', '.join(['?']*len(ids))), ids)
+            feats = {i: (mail or '', trigrams(key or ''), set((tlfs or '').split(',')) - {''})
+                for i, mail, key, tlfs in curs.fetchall()}
+            for block in blocks:
+                block = [i for i in block if i in feats]
+                for n, a in enumerate(block):
+                    for b in block[n+1:]:
+                        pair = (a, b) if a<b else (b, a)
+                        if pair in scored:
+                            continue
+                        scored.add(pair)
+                        score = self._dup_score(feats[a], feats[b])
+                        if score>=threshold:
+                            edges.append((pair, score))
+                            ra, rb = find(a), find(b)
+                            if ra!=rb:
+                                parent[max(ra, rb)] = min(ra, rb)
 
-    def search(self, pattern: int) -> list:
+        for rq in ['dup_phones', 'dup_mail', 'dup_names']:
+            # Пара только с похожим именем набирает не больше веса имени. Если порог выше, у пары выше
+            #    порога обязательно есть общий телефон или почта, и она уже найдена в их блоках
+            if rq=='dup_names' and threshold>self.dup_weights['name']:
+                continue
+            blocks, size = [], 0
+            for (ids,) in conn.execute(SQL[rq], (max_block,)):
+                block = [int(i) for i in ids.split(',')]
+                blocks.append(block)
+                size += len(block)
+                if size>=batch:
+                    score_blocks(blocks)
+                    blocks, size = [], 0
+            if blocks:
+                score_blocks(blocks)
+
+        groups = {}
+        for (a, _), score in edges:
+            groups.setdefault(find(a), []).append(score)
+        members = {}
+        for x in parent:
+            members.setdefault(find(x), set()).add(x)
+        res = [(sum(scores) / len(scores), sorted(members[root] | {root})) for root, scores in groups.items()]
+        yield from sorted(res, key=lambda x: (-x[0], x[1]))
+
+    def _dup_score(self, a: tuple, b: tuple) -> float:
+        '''
+        Оценка пары карточек по признакам (почта, триграммы имени, номера телефонов)
+        '''
+        w = self.dup_weights
+        name = 2 * len(a[1] & b[1]) / (len(a[1]) + len(b[1])) if a[1] and b[1] else 0.0
+        score = w['name'] * name + w['phone'] * bool(a[2] & b[2]) + w['mail'] * bool(a[0] and a[0]==b[0])
+        return min(1.0, score)
+
+    def merge_cards(self, ids: list, keep: int = None) -> int:
         '''
-        Поиск шаблона pattern в карточках. Регистрозависимый. Вернет список словарей-карточек
+        Сливает карточки ids в одну - keep (по умолчанию с наименьшим id) - одной транзакцией.
+        Телефоны всех карточек без повторов (номера сравниваются в нормализованном виде) занимают
+        свободные слоты tlf1-tlf3, не поместившиеся дописываются в comment вместе с подписями.
+        Комментарии всех карточек объединяются через "; ", пустые поля keep (адрес, место работы,
+        почта, сайт) заполняются из других карточек. Остальные карточки удаляются.
+        Вернет id оставшейся карточки или 0, если карточек с такими id меньше двух
         '''
-        my_keys = ['name', 'tlf1', 'comment1', 'tlf2', 'comment2', 'tlf3', 'comment3', 'adr', 'job', 
-                'mail', 'site', 'comment', 'cr_dt', 'upd_dt']
-        conn = sq3.connect(self.dbfile)
+        conn = self._connect()
         curs = conn.cursor()
-        # Формируем запрос к БД
-        rq = (" OR ".join(list(map((lambda x: "("+x+" LIKE '%{0}%')"), my_keys)))).format(pattern)
-        rqsearch = "SELECT * FROM cards WHERE {0};".format(rq)
-        curs.execute(rqsearch)
-        rsp = curs.fetchall()
-        conn.commit()        
-        # Оформляем результат поиска
-        return [dict(zip(['id']+my_keys, i)) for i in rsp]
+        self._begin(conn)
+        try:
+            ids = sorted(set(ids))
+            curs.execute(SQL['cards_by_ids'].format(', '.join(['?']*len(ids))), ids)
+            cards = {i['id']: i for i in Card.from_rows(curs.fetchall())}
+            keep = min(cards) if keep is None and cards else keep
+            if len(cards)<2 or keep not in cards:
+                conn.rollback()
+                return 0
+            order = [cards[keep]] + [cards[i] for i in sorted(cards) if i!=keep]
+
+            # Повторный номер не добавляется, но его подпись заполняет пустую подпись первого
+            phones, seen = [], {}
+            for crd in order:
+                for n in (1, 2, 3):
+                    number, digits = crd['tlf{0}'.format(n)], normalize_phone(crd['tlf{0}'.format(n)])
+                    label = crd['comment{0}'.format(n)]
+                    if not digits:
+                        continue
+                    if digits not in seen:
+                        seen[digits] = len(phones)
+                        phones.append((number, label))
+                    elif label and not phones[seen[digits]][1]:
+                        phones[seen[digits]] = (phones[seen[digits]][0], label)
+            fields = {}
+            for n in (1, 2, 3):
+                number, label = phones[n-1] if n<=len(phones) else ('', '')
+                fields['tlf{0}'.format(n)], fields['comment{0}'.format(n)] = number, label
+
+            comments = []
+            for crd in order:
+                if crd['comment'] and crd['comment']!='No comment' and crd['comment'] not in comments:
+                    comments.append(crd['comment'])
+            comments += [' '.join([i for i in (number, label) if i]) for number, label in phones[3:]]
+            fields['comment'] = '; '.join(comments) or cards[keep]['comment']
+            for key in ['adr', 'job', 'mail', 'site']:
+                fields[key] = next((crd[key] for crd in order if crd[key]), cards[keep][key])
+
+            changed = {k: v for k, v in fields.items() if v!=cards[keep][k]}
+            if changed:
+                self._update_row(curs, keep, changed, timestamp())
+            for card_id in cards:
+                if card_id!=keep:
+                    curs.execute(SQL['delete_card'], (card_id,))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        for card_id in cards:
+            self._cache_invalidate(card_id)
+        return keep
 
     def any_req(self, db_request: str) -> list:
         '''
         Произвольный sqlite-запрос к базе данных. Имя таблицы - cards
         '''
-        conn = sq3.connect(self.dbfile)
+        conn = self._connect()
         curs = conn.cursor()
+        changes = conn.total_changes
         curs.execute(db_request)
         rsp = curs.fetchall()
         conn.commit()
+        # Запрос мог изменить любые карточки
+        if conn.total_changes!=changes:
+            self._cache_invalidate()
         return rsp
 
 
+class AsyncCardList():
+    '''
+    Асинхронная обёртка над CardList для работы из asyncio. Все методы CardList доступны как
+    сопрограммы (await obj.get_card(1)), выполняются в отдельных потоках и не блокируют цикл событий.
+    Чтение идёт через пул из readers потоков (каждый со своим соединением, в режиме WAL читатели не
+    мешают друг другу), запись - через один поток, поэтому записи выполняются строго по очереди.
+    max_pending - ограничение количества одновременно выполняемых и ожидающих запросов: при его
+    достижении новые вызовы ждут освобождения места
+    obj.iter_search(pattern: str) - асинхронный генератор результатов поиска
+    obj.close() - сопрограмма, останавливает потоки и закрывает соединения
+    '''
+
+    # Методы CardList, изменяющие БД. any_req может быть чем угодно, поэтому тоже идёт через писателя
+    write_methods = {'new_card', 'new_cards', 'update_card', 'update_fields', 'update_cards', 'delete_card',
+        'import_file', 'merge_cards', 'trim_changes', 'compact', 'any_req'}
+    read_methods = {'get_card', 'has_card', 'search', 'search_fuzzy', 'search_page', 'find_by_phone', 'row_count',
+        'avail_id', 'export_file', 'last_change', 'backup', 'refresh_replica', 'cache_stats', 'stats'}
+
+    def __init__(self, dbfilename: str, readers: int = 4, max_pending: int = 256, **kwargs):
+        '''
+        dbfilename и kwargs передаются в CardList
+        '''
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        self.cards = CardList(dbfilename, **kwargs)
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='tdb-read')
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tdb-write')
+        self._pending = asyncio.Semaphore(max_pending)
+
+    async def _run(self, executor, fn, *args, **kwargs):
+        '''
+        Выполняет fn(*args, **kwargs) в executor (ThreadPoolExecutor), соблюдая ограничение max_pending
+        '''
+        import asyncio
+        async with self._pending:
+            return await asyncio.get_running_loop().run_in_executor(executor, ft.partial(fn, *args, **kwargs))
+
+    def __getattr__(self, name: str):
+        if name in self.write_methods or name in self.read_methods:
+            executor = self._writer if name in self.write_methods else self._readers
+            fn = getattr(self.cards, name)
+
+            async def method(*args, **kwargs):
+                return await self._run(executor, fn, *args, **kwargs)
+            method.__name__ = name
+            method.__doc__ = fn.__doc__
+            return method
+        raise AttributeError(name)
+
+    async def iter_search(self, pattern: str = '', mode: str = 'like', page_size: int = 500):
+        '''
+        Асинхронный генератор результатов поиска. Страницы читаются по мере потребления, следующая
+        страница запрашивается, пока обрабатывается текущая, поэтому в памяти не больше двух страниц
+        '''
+        import asyncio
+        task = asyncio.ensure_future(self._run(self._readers, self.cards.search_page, pattern, None, page_size, mode))
+        try:
+            while task is not None:
+                page, after = await task
+                task = None
+                if after is not None:
+                    task = asyncio.ensure_future(self._run(self._readers, self.cards.search_page, pattern, after,
+                        page_size, mode))
+                for crd in page:
+                    yield crd
+        finally:
+            if task is not None:
+                task.cancel()
+
+    async def close(self):
+        '''
+        Дожидается выполнения начатых запросов, останавливает потоки и закрывает соединения с БД
+        '''
+        import asyncio
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._writer.shutdown)
+        await loop.run_in_executor(None, self._readers.shutdown)
+        self.cards.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+class CardListFederation():
+    '''
+    Несколько файлов БД (шардов), с которыми работают как с одной книгой: поиск идёт во всех
+    шардах параллельно, результаты сливаются в один список. Каждая найденная карточка помечается
+    полем 'shard' - именем файла без .tdb; id карточки остаётся её номером внутри своего шарда,
+    поэтому ссылка на карточку - пара (shard, id)
+    obj.shards - словарь {имя шарда: CardList}
+    obj.search(pattern: str, mode: str = 'like', limit: int = None) -> list - поиск во всех шардах
+    obj.search_fuzzy(query: str, threshold: float = 0.45, limit: int = 20) -> list - нечёткий поиск по имени
+    obj.find_by_phone(number: str, suffix: int = None) -> list - поиск по номеру телефона
+    obj.get_card(shard: str, card_id: int) -> dict - карточка из указанного шарда
+    obj.new_card(crd: dict) -> tuple - добавить карточку в шард, выбранный маршрутизацией
+    obj.new_cards(cards) -> tuple - массовое добавление с маршрутизацией каждой карточки
+    obj.row_count() -> int - общее количество карточек
+    obj.close() - закрыть все шарды
+    '''
+
+    def __init__(self, dbfiles, route='name', workers: int = 8, **kwargs):
+        '''
+        dbfiles - имя каталога (берутся все файлы *.tdb в нём) или список имён файлов БД.
+        route - куда добавлять новые карточки: имя поля (шард выбирается по контрольной сумме его
+        значения, одинаковые значения всегда попадают в один шард) или функция route(crd) -> имя шарда.
+        workers - число потоков для параллельных запросов; kwargs передаются каждому CardList
+        '''
+        if isinstance(dbfiles, str):
+            dbfiles = [os.path.join(dbfiles, i) for i in sorted(os.listdir(dbfiles)) if i.endswith('.tdb')]
+        self.shards = {}
+        for filename in dbfiles:
+            name = os.path.splitext(os.path.basename(filename))[0]
+            if name in self.shards:
+                raise ValueError('duplicate shard name: {0}'.format(name))
+            self.shards[name] = CardList(filename, **kwargs)
+        self.route = route
+        # sqlite3 отпускает GIL на время запроса, поэтому потоков достаточно
+        from concurrent.futures import ThreadPoolExecutor
+        self._pool = ThreadPoolExecutor(max_workers=max(1, min(workers, len(self.shards))),
+            thread_name_prefix='tdb-shard')
+
+    def _map(self, method: str, *args, **kwargs) -> list:
+        '''
+        Вызывает method(*args, **kwargs) у всех шардов параллельно. Вернет список пар (имя шарда, результат)
+        '''
+        futures = [(name, self._pool.submit(getattr(db, method), *args, **kwargs)) for name, db in self.shards.items()]
+        return [(name, fut.result()) for name, fut in futures]
+
+    @staticmethod
+    def _tag(name: str, crd: dict) -> dict:
+        # Копия: карточка могла прийти из кэша CardList
+        crd = dict(crd)
+        crd['shard'] = name
+        return crd
+
+    def search(self, pattern: str, mode: str = 'like', ignore_case: bool = True, limit: int = None) -> list:
+        '''
+        Поиск во всех шардах (mode - как в CardList.search). Каждый шард возвращает не больше limit
+        карточек. При mode='fts' результаты ранжируются по месту карточки в выдаче своего шарда
+        (оценки bm25 разных файлов несравнимы: у каждого своя статистика слов), при равенстве - в
+        порядке шардов; при mode='like' - по имени. mode='fuzzy' - см. search_fuzzy
+        '''
+        if mode=='fuzzy':
+            return [crd for _, crd in self.search_fuzzy(pattern, limit=limit or 20)]
+        res = self._map('search', pattern, mode, ignore_case, limit)
+        if mode=='fts':
+            ranked = sorted([(rank, num, self._tag(name, crd)) for num, (name, cards) in enumerate(res)
+                for rank, crd in enumerate(cards)], key=lambda x: x[:2])
+            cards = [crd for _, _, crd in ranked]
+        else:
+            cards = sorted([self._tag(name, crd) for name, cards in res for crd in cards],
+                key=lambda x: ((x['name'] or '').casefold(), x['shard'], x['id']))
+        return cards if limit is None else cards[:limit]
+
+    def search_fuzzy(self, query: str, threshold: float = 0.45, limit: int = 20) -> list:
+        '''
+        Нечёткий поиск по имени во всех шардах. Похожесть считается одинаково во всех файлах,
+        поэтому общий список просто упорядочен по ней. Вернет не более limit пар (похожесть, карточка)
+        '''
+        res = [(score, self._tag(name, crd)) for name, found in self._map('search_fuzzy', query, threshold, limit)
+            for score, crd in found]
+        return sorted(res, key=lambda x: (-x[0], x[1]['shard'], x[1]['id']))[:limit]
+
+    def find_by_phone(self, number: str, suffix: int = None) -> list:
+        '''
+        Поиск карточек по номеру телефона во всех шардах, результаты упорядочены по имени
+        '''
+        return sorted([self._tag(name, crd) for name, cards in self._map('find_by_phone', number, suffix)
+            for crd in cards], key=lambda x: ((x['name'] or '').casefold(), x['shard'], x['id']))
+
+    def get_card(self, shard: str, card_id: int) -> dict:
+        crd = self.shards[shard].get_card(card_id)
+        return self._tag(shard, crd) if crd else crd
+
+    def row_count(self) -> int:
+        return sum(count for _, count in self._map('row_count'))
+
+    def shard_for(self, crd: dict) -> str:
+        '''
+        Имя шарда, в который попадёт новая карточка crd
+        '''
+        if callable(self.route):
+            name = self.route(crd)
+            if name not in self.shards:
+                raise KeyError('unknown shard: {0}'.format(name))
+            return name
+        # crc32, а не hash(): hash() строк меняется от запуска к запуску
+        names = list(self.shards)
+        return names[zlib.crc32(str(crd.get(self.route, '')).encode('utf-8')) % len(names)]
+
+    def new_card(self, crd: dict):
+        '''
+        Добавляет карточку в шард, выбранный по route. Вернет пару (имя шарда, id) или 1, если
+        карточку добавить не удалось (как CardList.new_card - например, нет поля 'name')
+        '''
+        name = self.shard_for(crd)
+        ids, errors = self.shards[name].new_cards([crd])
+        return (name, ids[0]) if ids else 1
+
+    def new_cards(self, cards, batch_size: int = 1000) -> tuple:
+        '''
+        Массовое добавление: карточки раскладываются по шардам (route) и пишутся в шарды параллельно.
+        Вернет (список пар (имя шарда, id) в порядке входных карточек, список ошибок (номер, текст))
+        '''
+        groups, errors = {}, []
+        for num, crd in enumerate(cards):
+            if not isinstance(crd, collections.abc.Mapping) or 'name' not in crd:
+                errors.append((num, "no 'name' field"))
+                continue
+            groups.setdefault(self.shard_for(crd), []).append((num, crd))
+        futures = {name: self._pool.submit(self.shards[name].new_cards, [crd for _, crd in items], batch_size)
+            for name, items in groups.items()}
+        refs = []
+        for name, items in groups.items():
+            ids, errs = futures[name].result()
+            failed = {i for i, _ in errs}
+            nums = [num for i, (num, _) in enumerate(items) if i not in failed]
+            refs.extend(zip(nums, [(name, i) for i in ids]))
+            errors.extend([(items[i][0], text) for i, text in errs])
+        return [ref for _, ref in sorted(refs)], sorted(errors)
+
+    def close(self):
+        self._pool.shutdown()
+        for db in self.shards.values():
+            db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 # Собственно, программа для консоли. Файл можно использовать как модуль, подключив его к GUI
 if __name__=='__main__':
 
@@ -225,6 +2560,154 @@ if __name__=='__main__':
         return result
 
 
+    # Перевод в нижний регистр только латиницы - так сравнивает строки LIKE в sqlite
+    _ASCII_LOWER = {i: i + 32 for i in range(65, 91)}
+
+    def like_match(crd: dict, pattern: str) -> bool:
+        '''
+        Условие поиска search(mode='like') для уже прочитанной карточки: подстрока pattern в любом из полей
+        '''
+        patt = pattern.translate(_ASCII_LOWER)
+        return any(patt in str(crd[k]).translate(_ASCII_LOWER) for k in _LIKE_KEYS if crd[k] is not None)
+
+
+    class Keyboard():
+        '''
+        Чтение нажатых клавиш без ожидания Enter: в Windows - через msvcrt, в остальных системах
+        терминал на время работы переводится в режим cbreak
+        '''
+        def __enter__(self):
+            import sys
+            try:
+                import msvcrt
+                self.msvcrt, self.fd = msvcrt, None
+            except ImportError:
+                import termios, tty, codecs
+                self.msvcrt, self.fd = None, sys.stdin.fileno()
+                self.saved = termios.tcgetattr(self.fd)
+                tty.setcbreak(self.fd)
+                # Русская буква - несколько байт, которые могут прийти разными чтениями
+                self.decoder = codecs.getincrementaldecoder(sys.stdin.encoding or 'utf-8')(errors='ignore')
+            return self
+
+        def __exit__(self, exc_type, exc_val, exc_tb):
+            if self.fd is not None:
+                import termios
+                termios.tcsetattr(self.fd, termios.TCSADRAIN, self.saved)
+
+        def get(self, timeout: float) -> str:
+            '''
+            Вернет символы, набранные за timeout секунд (пустая строка - ничего не нажато)
+            '''
+            if self.msvcrt is not None:
+                stop, keys = time.monotonic() + timeout, ''
+                while True:
+                    while self.msvcrt.kbhit():
+                        key = self.msvcrt.getwch()
+                        if key in ('\x00', '\xe0'):
+                            # Стрелки и функциональные клавиши - два символа, пропускаем оба
+                            self.msvcrt.getwch()
+                        else:
+                            keys += key
+                    if keys or time.monotonic()>=stop:
+                        return keys
+                    time.sleep(0.01)
+            import select
+            if not select.select([self.fd], [], [], timeout)[0]:
+                return ''
+            return self.decoder.decode(os.read(self.fd, 64))
+
+
+    class LiveSearch():
+        '''
+        Поиск по мере ввода. Запросы выполняет отдельный поток и публикует в state найденное
+        страницами, по мере чтения: кортеж (шаблон, первые rows карточек, сколько найдено, поиск
+        закончен). Новый шаблон прерывает выполняемый запрос. Если новый шаблон содержит предыдущий,
+        а предыдущий поиск нашёл все совпадения (не больше keep), результат отбирается из
+        предыдущего без обращения к БД
+        '''
+        def __init__(self, db: CardList, rows: int, keep: int = 1000):
+            self.db, self.rows, self.keep = db, rows, keep
+            self.state = ('', [], 0, True)
+            # Номер текущего шаблона: поиск по устаревшему шаблону прекращается и ничего не публикует
+            self._gen = 0
+            self._job, self._closed = None, False
+            # Шаблон и все найденные карточки последнего законченного поиска
+            self._prev = None
+            self._conn = None
+            self._cond = threading.Condition()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+        def start(self, pattern: str):
+            with self._cond:
+                self._gen += 1
+                self._job = (self._gen, pattern)
+                self._cond.notify()
+                if self._conn is not None:
+                    self._conn.interrupt()
+
+        def close(self):
+            with self._cond:
+                self._gen += 1
+                self._closed = True
+                self._cond.notify()
+                if self._conn is not None:
+                    self._conn.interrupt()
+            self._thread.join()
+
+        def _run(self):
+            while True:
+                with self._cond:
+                    while self._job is None and not self._closed:
+                        self._cond.wait()
+                    if self._closed:
+                        # Соединение потока больше никому не понадобится
+                        if self._conn is not None:
+                            self.db._release(self._conn)
+                        return
+                    (gen, pattern), self._job = self._job, None
+                self._conn = self.db._reader()
+                try:
+                    self._search(gen, pattern)
+                except sq3.OperationalError as e:
+                    if 'interrupted' not in str(e):
+                        raise
+                    # Прерывание, предназначенное прошлому шаблону, могло достаться уже этому
+                    with self._cond:
+                        if self._gen==gen and self._job is None:
+                            self._job = (gen, pattern)
+
+        def _publish(self, gen: int, pattern: str, found: list, done: bool):
+            if gen==self._gen:
+                self.state = (pattern, found[:self.rows], len(found), done)
+
+        def _search(self, gen: int, pattern: str):
+            prev = self._prev
+            if not pattern:
+                self._publish(gen, pattern, [], True)
+                return
+            # В LIKE символы % и _ - подстановочные, отбирать такие шаблоны в памяти не пытаемся
+            if prev is not None and prev[0] in pattern and '%' not in pattern and '_' not in pattern:
+                found = [i for i in prev[1] if like_match(i, pattern)]
+                self._prev = (pattern, found)
+                self._publish(gen, pattern, found, True)
+                return
+            # Первая страница - ровно на экран, чтобы показать её как можно раньше
+            found, after, size = [], None, self.rows
+            while True:
+                page, after = self.db.search_page(pattern, after, size)
+                if gen!=self._gen:
+                    return
+                found.extend(page)
+                done = after is None
+                self._publish(gen, pattern, found, done)
+                if done or len(found)>=self.keep:
+                    break
+                size = 500
+            self._prev = (pattern, found) if done else None
+
+
     class DataBase(CardList):
         '''
         Адаптация класса базы данных справочника для работы с консолью
@@ -289,95 +2772,47 @@ if __name__=='__main__':
                         break
                 elif ch3=='1':
                     print('Edit card. Input new values. Press "Enter" to skip or "0" to stop.')
-                    while True:
-                        edited_card = {}
-                        print('\nid:', crd_to_show['id'])
-
-                        nvc = inp_val('Name', 'name', crd_to_show)
-                        if nvc=='**':
-                            break
-                        else:
-                            self.update_card(crd_to_show['id'], 'name', nvc)
-
-                        nvc = inp_val('Telephone 1', 'tlf1', crd_to_show)
-                        if nvc=='**':
-                            break
-                        else:
-                            self.update_card(crd_to_show['id'], 'tlf1', nvc)
-
-                        nvc = inp_val('Comment 1', 'comment1', crd_to_show)
-                        if nvc=='**':
-                            break
-                        else:
-                            self.update_card(crd_to_show['id'], 'comment1', nvc)
-
-                        nvc = inp_val('Telephone 2', 'tlf2', crd_to_show)
-                        if nvc=='**':
-                            break
-                        else:
-                            self.update_card(crd_to_show['id'], 'tlf2', nvc)
-                        
-                        nvc = inp_val('Comment 2', 'comment2', crd_to_show)
-                        if nvc=='**':
-                            break
-                        else:
-                            self.update_card(crd_to_show['id'], 'comment2', nvc)
-
-                        nvc = inp_val('Telephone 3', 'tlf3', crd_to_show)
-                        if nvc=='**':
-                            break
-                        else:
-                            self.update_card(crd_to_show['id'], 'tlf3', nvc)
-                        
-                        nvc = inp_val('Comment 3', 'comment3', crd_to_show)
-                        if nvc=='**':
-                            break
-                        else:
-                            self.update_card(crd_to_show['id'], 'comment3', nvc)                          
-
-                        nvc = inp_val('Address', 'adr', crd_to_show)
-                        if nvc=='**':
-                            break
-                        else:
-                            self.update_card(crd_to_show['id'], 'adr', nvc)                        
-
-                        nvc = inp_val('Organization', 'job', crd_to_show)
-                        if nvc=='**':
-                            break
-                        else:
-                            self.update_card(crd_to_show['id'], 'job', nvc)
-
-                        nvc = inp_val('E-mail', 'mail', crd_to_show)
-                        if nvc=='**':
-                            break
-                        else:
-                            self.update_card(crd_to_show['id'], 'mail', nvc)
-
-                        nvc = inp_val('Personal site', 'site', crd_to_show)
-                        if nvc=='**':
-                            break
-                        else:
-                            self.update_card(crd_to_show['id'], 'site', nvc)
-
-                        nvc = inp_val('Comment', 'comment', crd_to_show)
+                    edited_card = {}
+                    print('\nid:', crd_to_show['id'])
+                    stopped = False
+                    for name_val, card_key in [('Name', 'name'), ('Telephone 1', 'tlf1'), ('Comment 1', 'comment1'),
+                            ('Telephone 2', 'tlf2'), ('Comment 2', 'comment2'), ('Telephone 3', 'tlf3'),
+                            ('Comment 3', 'comment3'), ('Address', 'adr'), ('Organization', 'job'), ('E-mail', 'mail'),
+                            ('Personal site', 'site'), ('Comment', 'comment')]:
+                        nvc = inp_val(name_val, card_key, crd_to_show)
                         if nvc=='**':
+                            stopped = True
                             break
-                        else:
-                            self.update_card(crd_to_show['id'], 'comment', nvc)                       
+                        elif nvc!=crd_to_show[card_key]:
+                            edited_card[card_key] = nvc
 
-                        self.show_card(self.get_card(crd_to_show['id']))
-
-                        break
+                    # Все введённые до остановки изменения записываются в БД одним запросом
+                    if edited_card:
+                        self.update_fields(crd_to_show['id'], edited_card)
+                        crd_to_show = self.get_card(crd_to_show['id'])
+                    if not stopped:
+                        self.show_card(crd_to_show)
                 else:
                     print('Error')
             return res    
 
-        def search_partial(self, patt: str) -> list:
+        def search_partial(self, patt: str, mode: str = 'like', after=None, page_size: int = 20) -> tuple:
+            '''
+            Одна страница выборки из БД по шаблону, возвращает удобные для отображения в консоли строки,
+            список id на странице и продолжение для следующей страницы (None - страница последняя)
+            '''
+            found, nxt = self.search_page(patt, after, page_size, mode)
+            res_lst = self.format_table(found)
+            # Список доступных id в текущей выборке
+            local_id_avail = [i['id'] for i in found]
+            return (res_lst, local_id_avail, nxt)
+
+        def format_table(self, found: list) -> list:
             '''
-            Выборка из БД по шаблону, возвращает удобные для отображения в консоли строки
+            Строки таблицы (id, имя, телефон, комментарий) для вывода карточек found в консоль
             '''
             # Добавляем строку заголовков
-            rsp = [{'id': 'id', 'name': 'name', 'tlf1': 'telephone', 'comment': 'comment'}] + self.search(ptt)
+            rsp = [{'id': 'id', 'name': 'name', 'tlf1': 'telephone', 'comment': 'comment'}] + found
             # Собираем длины всех элементов в двумерный список, транспонируем его
             len_lst = list(zip(*[[len(str(i['id'])), len(i['name']), len(i['tlf1']), len(i['comment'])] for i in rsp]))
             # Результирующий список с подогнанными длинами строк
@@ -387,9 +2822,65 @@ if __name__=='__main__':
                 ('{0: <{1}}'.format(i['tlf1'], max(len_lst[2])))[:20], 
                 ('{0: <{1}}'.format(i['comment'], max(len_lst[3])))[:20] ])
             for i in (rsp)]
-            # Список доступных id в текущей выборке
-            local_id_avail = [i['id'] for i in rsp[1:]]
-            return (res_lst, local_id_avail)
+            # Пустая строка отделяет заголовки от самой таблицы
+            res_lst.insert(1, '')
+            return res_lst
+
+        def live_search(self) -> str:
+            '''
+            Поиск подстроки (как search с mode='like') по мере ввода, без Enter: найденное выводится
+            сразу, страницами по мере чтения, но не больше, чем помещается на экране. Вернет набранный
+            шаблон после Enter или пустую строку после Esc
+            '''
+            import sys, shutil
+            if not sys.stdin.isatty():
+                print('\nSearch as you type needs a terminal')
+                return ''
+            rows = max(shutil.get_terminal_size().lines - 6, 5)
+            live = LiveSearch(self, rows)
+            pattern, shown = '', None
+            try:
+                with Keyboard() as kbd:
+                    while True:
+                        if live.state is not shown:
+                            shown = live.state
+                            self.show_live(pattern, shown)
+                        keys = kbd.get(0.05)
+                        # Esc и последовательности клавиш-стрелок, начинающиеся с него
+                        if keys.startswith('\x1b'):
+                            if keys=='\x1b':
+                                return ''
+                            continue
+                        old = pattern
+                        for key in keys:
+                            if key in ('\r', '\n'):
+                                return pattern
+                            elif key in ('\x7f', '\x08'):
+                                pattern = pattern[:-1]
+                            elif key.isprintable():
+                                pattern += key
+                        if pattern!=old:
+                            live.start(pattern)
+                            self.show_live(pattern, shown)
+            finally:
+                live.close()
+                print()
+
+        def show_live(self, pattern: str, state: tuple):
+            '''
+            Перерисовывает экран поиска по мере ввода: найденное для state и строку ввода
+            '''
+            patt, found, count, done = state
+            print('\033[H\033[J', end='')
+            if not pattern:
+                print('Type to search, Enter - select, Esc - cancel\n')
+            elif patt!=pattern or not done:
+                print('Found: {0}+, searching...\n'.format(count))
+            else:
+                print('Found: {0}{1}\n'.format(count, '' if count<=len(found) else ', first {0} shown'.format(len(found))))
+            if found:
+                print(*self.format_table(found), sep='\n')
+            print('\nSearch: {0}'.format(pattern), end='', flush=True)
         
 
     db = DataBase(dbname)
@@ -400,7 +2891,7 @@ if __name__=='__main__':
     while mainloop:
 
         print('\n1. Database filename: "{0}", cards in db: {1}'.format(db.dbfile, db.row_count()))
-        print('2. Search, view and update cards\n3. New card\n0. End')
+        print('2. Search, view and update cards\n3. New card\n4. Backup and compact database\n0. End')
         ch = input('Enter you choice: ')
 
         if ch=='0':
@@ -452,35 +2943,55 @@ if __name__=='__main__':
             while True:
                 print('\nInput ID of required card, pattern to search, or 0 to stop.')
                 print('Use "*" request to view full DB, or "*some_pattern" to find some_pattern in cards')
+                print('Use "/" to search as you type')
                 ch1 = input('Enter you choice: ')
+                live = ch1=='/'
+                if live:
+                    ch1 = db.live_search()
+                    if ch1=='':
+                        continue
                 if (ch1=='0' or ch1==''):
                     break
                 elif ch1.isdigit():
-                    if int(ch1) in db.avail_id():
+                    if db.has_card(int(ch1)):
                         # Если запрос - число, входящее в список доступных id, то выводим соответствующую
                         #    карточку для просмотра и редактирования
-                        db.view_and_update_card(ch1)
+                        db.view_and_update_card(int(ch1))
                     else:
-                        print("\nId {0} not found! Available ids: {1}".format(int(ch1), (', '.join(list(map(str, db.avail_id()))))[:200]  ))
+                        print("\nId {0} not found! Available ids: {1}".format(int(ch1), (', '.join(list(map(str, db.avail_id(50)))))[:200]  ))
                 else: 
                     # Остальные варианты запроса считаем шаблонами. Убираем звёздочку в начале шаблона
                     if ch1[0]=='*':
                         ptt = ch1[1:]
                     else:
                         ptt = ch1
-                    srch, av_ids = db.search_partial(ptt)
+                    # Сначала ищем по полнотекстовому индексу, и только если ничего не нашлось - подстроку
+                    #    во всех полях (например, часть номера телефона). После поиска по мере ввода
+                    #    показываем те же карточки, что он нашёл, - подстрокой
+                    mode = 'like' if live else 'fts'
+                    srch, av_ids, nxt = db.search_partial(ptt, mode)
+                    if len(av_ids)==0 and mode=='fts':
+                        mode = 'like'
+                        srch, av_ids, nxt = db.search_partial(ptt, mode)
+                    # Продолжения для уже показанных страниц, чтобы можно было вернуться назад
+                    pages = [None]
                     if len(av_ids)>0:
-                        print('\nHave a {0} matches:'.format(len(av_ids)))
                         while True:
-                            print('\n')
-                            # Добавляем пустую строку для отделения заголовков от самой таблицы
-                            if srch[1]!='':
-                                srch.insert(1, '')
+                            print('\n\nPage {0}:'.format(len(pages)))
                             print(*srch, sep='\n')
-                            print('\nSelect id card to update or 0 to perform another search.')
+                            print('\nSelect id card to update, "n" - next page, "b" - previous page, 0 - another search.')
                             ch2 = input('Enter you choice: ')
                             if ch2=='0':
                                 break
+                            elif ch2 in ('n', 'b'):
+                                if ch2=='n' and nxt is not None:
+                                    pages.append(nxt)
+                                elif ch2=='b' and len(pages)>1:
+                                    pages.pop()
+                                else:
+                                    print('\nNo more pages!')
+                                    continue
+                                srch, av_ids, nxt = db.search_partial(ptt, mode, pages[-1])
                             elif ch2.isdigit():
                                 if int(ch2) in av_ids:
                                     # Показываем полную карточку
@@ -614,5 +3125,19 @@ if __name__=='__main__':
                     print('New card is NOT created! Have a some problems')
                 break
 
+        # Копия БД и возврат файлу места после удалений - без остановки других процессов
+        elif ch=='4':
+            def show(done, total):
+                print('\r{0}%'.format(done * 100 // max(total, 1)), end='', flush=True)
+            print('\n1. Backup\n2. Compact\n0. Back')
+            ch7 = input('Enter you choice: ')
+            if ch7=='1':
+                dest = input('Backup filename: ') or '{0}.bak'.format(db.dbfile)
+                pages, rate = db.backup(dest, progress=show)
+                print('\n{0} pages copied to "{1}", {2:.1f} MB/s'.format(pages, dest, rate))
+            elif ch7=='2':
+                pages, rate = db.compact(progress=show)
+                print('\n{0} pages freed, {1:.1f} MB/s'.format(pages, rate))
+
         else:
             pass